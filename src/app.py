@@ -17,21 +17,79 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+from typing import Optional
+
 import falcon
 
+from src import settings
+from src.prepull import PrePullCache
+from src.prepull import PrePullWatcher
+from src.profiling import CpuProfiler
+from src.profiling import MemoryProfiler
+from src.reaper import WorkflowReaper
 from src.resources import HealthCheckResource
+from src.resources import ProfileResource
 from src.resources import WorkflowsResource
+from src.routing import create_routing_policy
 from src.services import KubernetesService
 from src.services import KubernetesServiceABC
+from src.services import MultiClusterKubernetesService
 
 
-def create_app(kubernetes_service: KubernetesServiceABC):
+def create_app(
+    kubernetes_service: KubernetesServiceABC,
+    shared_env=False,
+    prepull_cache: Optional[PrePullCache] = None,
+    profiling_token: Optional[str] = None,
+):
     app = falcon.API()
     app.add_route("/health-check", HealthCheckResource())
-    app.add_route("/workflows", WorkflowsResource(kubernetes_service))
+    app.add_route(
+        "/workflows",
+        WorkflowsResource(kubernetes_service, shared_env, prepull_cache),
+    )
+    # debug routes exist only when enabled, there is no overhead otherwise
+    if profiling_token:
+        cpu_profiler = CpuProfiler(focus=WorkflowsResource.on_post.__code__)
+        app.add_route(
+            "/debug/profile/cpu",
+            ProfileResource(cpu_profiler, "cpu", profiling_token),
+        )
+        app.add_route(
+            "/debug/profile/memory",
+            ProfileResource(MemoryProfiler(), "memory", profiling_token),
+        )
     return app
 
 
 def serve_app():
-    kubernetes_service = KubernetesService()
-    return create_app(kubernetes_service)
+    if settings.KUBE_CONTEXTS:
+        routing_policy = create_routing_policy(
+            settings.ROUTING_POLICY,
+            pins=settings.ROUTING_PINS,
+            cache_seconds=settings.ROUTING_LOAD_CACHE_SECONDS,
+        )
+        kubernetes_service = MultiClusterKubernetesService.from_contexts(
+            settings.KUBE_CONTEXTS, routing_policy
+        )
+    else:
+        kubernetes_service = KubernetesService()
+    if settings.REAPER_ENABLED:
+        WorkflowReaper(
+            kubernetes_service,
+            settings.REAPER_INTERVAL_SECONDS,
+            settings.REAPER_GRACE_SECONDS,
+        ).start()
+
+    prepull_cache = None
+    if settings.PREPULL:
+        prepull_cache = PrePullCache(settings.PREPULL_CACHE_SECONDS)
+        PrePullWatcher(
+            kubernetes_service, prepull_cache, settings.PREPULL_WATCH_INTERVAL_SECONDS
+        ).start()
+    return create_app(
+        kubernetes_service,
+        shared_env=settings.SHARED_ENV,
+        prepull_cache=prepull_cache,
+        profiling_token=settings.PROFILING_TOKEN,
+    )
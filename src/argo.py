@@ -17,6 +17,7 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import time
 from random import choice
 from string import ascii_lowercase
 from string import digits
@@ -24,21 +25,54 @@ from typing import Any
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Sequence
 
 from src import custom_logger
+from src import settings
 from src.dao import Workflow
+from src.topology import MASTER_PROFILE
+from src.topology import SLAVE_PROFILE
+from src.topology import plan_topology
 
 # TODO: move to configuration file
 GRAPHQL_URL = "http://hasura.hasura.svc.cluster.local/v1alpha1/graphql"
+
+MANAGED_BY_LABEL = "app.kubernetes.io/managed-by"
+MANAGED_BY = "bolt-workflow-creator"
+TENANT_LABEL = "bolt/tenant-id"
+PROJECT_LABEL = "bolt/project-id"
+EXECUTION_LABEL = "bolt/execution-id"
+PREPULL_LABEL = "bolt/prepull"
+# Set by Argo once the workflow finished
+COMPLETED_LABEL = "workflows.argoproj.io/completed"
+# Unix time after which the workflow is terminated by the reaper
+DEADLINE_ANNOTATION = "bolt/deadline"
+STEP_DEADLINE_SECONDS = 600
+MASTERS_GROUP = "load-tests-workers-master"
+SLAVES_GROUP = "load-tests-workers-slave"
+# Workflows submitted by this service which Argo has not marked as completed yet
+RUNNING_WORKFLOWS_SELECTOR = f"{MANAGED_BY_LABEL}={MANAGED_BY},{COMPLETED_LABEL}!=true"
+COMPLETED_WORKFLOWS_SELECTOR = f"{MANAGED_BY_LABEL}={MANAGED_BY},{COMPLETED_LABEL}=true"
 logger = custom_logger.setup_custom_logger(__file__)
 
 
-def create_argo_workflow(workflow: Workflow) -> Dict[str, Any]:
+def create_argo_workflow(
+    workflow: Workflow,
+    shared_env: bool = False,
+    prepull_groups: Sequence[str] = (),
+) -> Dict[str, Any]:
     """
     Returns argoproj.io/v1alpha1 Workflow as dict (in json format)
+
+    With `shared_env` the env vars shared between templates are not inlined,
+    they are read from the secret returned by `create_env_secret` instead.
+    The built image is pulled onto nodes of `prepull_groups` before execution.
     """
     pod_name = f"bolt-wf-{_postfix_generator()}"
     logger.info(f"Pod name: {pod_name}")
+    env_secret = _get_env_secret_name(pod_name) if shared_env else None
+    deadline = _get_workflow_deadline(workflow, prepull_groups)
+    reap_at = int(time.time()) + _get_reaping_delay(workflow, deadline)
 
     resource_definition = {
         "apiVersion": "argoproj.io/v1alpha1",
@@ -47,10 +81,19 @@ def create_argo_workflow(workflow: Workflow) -> Dict[str, Any]:
             "name": pod_name,
             # TODO specify namespace via some external config
             "namespace": "argo",
+            "labels": {
+                MANAGED_BY_LABEL: MANAGED_BY,
+                TENANT_LABEL: workflow.tenant_id,
+                PROJECT_LABEL: workflow.project_id,
+                EXECUTION_LABEL: workflow.execution_id,
+            },
+            "annotations": {DEADLINE_ANNOTATION: str(reap_at)},
         },
         "spec": {
             "entrypoint": "main",
-            "templates": _generate_templates(workflow),
+            "activeDeadlineSeconds": deadline,
+            "ttlStrategy": {"secondsAfterCompletion": settings.TEARDOWN_AFTER_SECONDS},
+            "templates": _generate_templates(workflow, env_secret, prepull_groups),
             "volumes": _generate_volumes(workflow),
             "serviceAccountName": "argo",
             "affinity": {
@@ -80,22 +123,101 @@ def create_argo_workflow(workflow: Workflow) -> Dict[str, Any]:
     return resource_definition
 
 
-def _generate_templates(workflow: Workflow):
-    main_template = _generate_main_template(workflow)
+def create_env_secret(
+    workflow: Workflow, argo_workflow: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    Returns v1 Secret with env vars of the workflow created with `shared_env`.
+    Owner reference to the workflow has to be set once the workflow is created.
+    """
+    data = {}
+    if workflow.job_load_tests is not None:
+        data.update(workflow.job_load_tests.env_vars or {})
+    data.update(
+        {
+            "BOLT_EXECUTION_ID": workflow.execution_id,
+            "BOLT_GRAPHQL_URL": GRAPHQL_URL,
+            "BOLT_HASURA_TOKEN": workflow.auth_token,
+        }
+    )
+    metadata = argo_workflow["metadata"]
+    return {
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": {
+            "name": _get_env_secret_name(metadata["name"]),
+            "namespace": metadata["namespace"],
+            "labels": dict(metadata["labels"]),
+        },
+        "type": "Opaque",
+        "stringData": data,
+    }
+
+
+def set_prepull_skips(argo_workflow: Dict[str, Any], images: Dict[str, List[str]]):
+    """
+    Makes the pre-pull of a node group conditional, it is skipped when the built
+    image is one of the `images` already pulled by the group
+    """
+    main_template = argo_workflow["spec"]["templates"][0]
+    for steps in main_template["steps"]:
+        for step in steps:
+            if step["template"] != "prepull":
+                continue
+            group = step["arguments"]["parameters"][0]["value"]
+            conditions = [
+                f"'{{{{workflow.outputs.parameters.image}}}}' != '{image}'"
+                for image in images.get(group, [])
+            ]
+            if conditions:
+                step["when"] = " && ".join(conditions)
+            else:
+                step.pop("when", None)
+
+
+def get_node_groups(workflow: Workflow) -> List[str]:
+    """
+    Returns node groups the steps of the workflow are scheduled on
+    """
+    groups = []
+    if workflow.job_load_tests is not None:
+        groups.append(MASTERS_GROUP)
+    if any(
+        job is not None
+        for job in (
+            workflow.job_pre_start,
+            workflow.job_post_stop,
+            workflow.job_monitoring,
+            workflow.job_load_tests,
+        )
+    ):
+        groups.append(SLAVES_GROUP)
+    return groups
+
+
+def _generate_templates(
+    workflow: Workflow, env_secret: Optional[str], prepull_groups: Sequence[str]
+):
+    main_template = _generate_main_template(workflow, prepull_groups)
     logger.info(f"The main template has been created.")
     build_template = _generate_build_template(workflow)
     logger.info(f"The bolt-builder template has been created.")
     execution_template = _generate_execution_template(workflow)
     logger.info(f"The execution template has been created.")
-    steps_templates = _generate_steps_templates(workflow)
+    steps_templates = _generate_steps_templates(workflow, env_secret)
     logger.info(f"The execution steps templates have been created.")
-    return [main_template, execution_template, build_template, *steps_templates]
+    templates = [main_template, execution_template, build_template, *steps_templates]
+    if prepull_groups:
+        templates.append(_generate_prepull_template(workflow))
+        logger.info(f"The prepull template has been created.")
+    return templates
 
 
 def _generate_build_template(workflow: Workflow):
     no_cache_value = "1" if workflow.no_cache else "0"
     return {
         "name": "build",
+        "activeDeadlineSeconds": settings.BUILD_DEADLINE_SECONDS,
         "container": {
             # TODO we should used tagged image, but for now pull always...
             "imagePullPolicy": "Always",
@@ -132,13 +254,79 @@ def _generate_build_template(workflow: Workflow):
     }
 
 
-def _generate_main_template(workflow: Workflow) -> Dict[str, Any]:
+def _generate_main_template(
+    workflow: Workflow, prepull_groups: Sequence[str]
+) -> Dict[str, Any]:
+    steps = [[{"name": "build", "template": "build"}]]
+    if prepull_groups:
+        steps.append(_generate_prepull_steps(workflow, prepull_groups))
+    steps.append([{"name": "execution", "template": "execution"}])
+    return {"name": "main", "steps": steps}
+
+
+def _generate_prepull_steps(
+    workflow: Workflow, prepull_groups: Sequence[str]
+) -> List[Dict[str, Any]]:
+    """
+    Pulls run in parallel, one pod per node expected to run a step of the group
+    """
+    topology = None
+    if workflow.job_load_tests is not None:
+        topology = plan_topology(
+            workflow.job_load_tests.users, workflow.job_load_tests.workers
+        )
+
+    steps = []
+    for group in prepull_groups:
+        count = 1
+        if topology is not None and group == MASTERS_GROUP:
+            count = len(topology.shards)
+        elif topology is not None and group == SLAVES_GROUP:
+            count = max(len(topology.slaves), 1)
+        steps.append(
+            {
+                "name": f"prepull-{group}",
+                "template": "prepull",
+                "arguments": {"parameters": [{"name": "group", "value": group}]},
+                "withSequence": {"count": str(count)},
+            }
+        )
+    return steps
+
+
+def _generate_prepull_template(workflow: Workflow) -> Dict[str, Any]:
+    prepull_id = "{{workflow.name}}-{{inputs.parameters.group}}"
     return {
-        "name": "main",
-        "steps": [
-            [{"name": "build", "template": "build"}],
-            [{"name": "execution", "template": "execution"}],
-        ],
+        "name": "prepull",
+        "inputs": {"parameters": [{"name": "group"}]},
+        "metadata": {"labels": {PREPULL_LABEL: prepull_id}},
+        "nodeSelector": {"group": "{{inputs.parameters.group}}"},
+        # spread the pulls, so each of them warms up a different node
+        "affinity": {
+            "podAntiAffinity": {
+                "preferredDuringSchedulingIgnoredDuringExecution": [
+                    {
+                        "weight": 100,
+                        "podAffinityTerm": {
+                            "labelSelector": {
+                                "matchLabels": {PREPULL_LABEL: prepull_id}
+                            },
+                            "topologyKey": "kubernetes.io/hostname",
+                        },
+                    }
+                ]
+            }
+        },
+        "activeDeadlineSeconds": STEP_DEADLINE_SECONDS,
+        "retryStrategy": {"limit": 2},
+        "container": {
+            "image": "{{workflow.outputs.parameters.image}}",
+            "command": ["python", "-c", "pass"],
+            "resources": {
+                "limits": {"cpu": "110m", "memory": "120Mi"},
+                "requests": {"cpu": "100m", "memory": "100Mi"},
+            },
+        },
     }
 
 
@@ -153,31 +341,42 @@ def _generate_execution_template(workflow: Workflow):
         if workflow.job_pre_start is not None:
             master_dependencies.append("pre-start")
 
-        tasks.append(
-            {
-                "name": "load-tests-master",
-                "template": "load-tests-master",
-                "dependencies": master_dependencies,
-            }
+        topology = plan_topology(
+            workflow.job_load_tests.users, workflow.job_load_tests.workers
         )
-
-        for i in range(workflow.job_load_tests.workers):
+        for master_index, shard in enumerate(topology.shards):
             tasks.append(
                 {
-                    "name": f"load-tests-slave-{i + 1:03}",
-                    "template": "load-tests-slave",
-                    "dependencies": ["load-tests-master"],
+                    "name": shard.master,
+                    "template": "load-tests-master",
+                    "dependencies": master_dependencies,
                     "arguments": {
                         "parameters": [
-                            {
-                                "name": "master-ip",
-                                "value": "{{tasks.load-tests-master.ip}}",
-                            }
+                            {"name": "master-index", "value": str(master_index)},
+                            {"name": "slaves", "value": str(len(shard.slaves))},
                         ]
                     },
                 }
             )
 
+            for slave in shard.slaves:
+                tasks.append(
+                    {
+                        "name": slave.name,
+                        "template": "load-tests-slave",
+                        "dependencies": [shard.master],
+                        "arguments": {
+                            "parameters": [
+                                {
+                                    "name": "master-ip",
+                                    "value": f"{{{{tasks.{shard.master}.ip}}}}",
+                                },
+                                {"name": "users", "value": str(slave.users)},
+                            ]
+                        },
+                    }
+                )
+
     if workflow.job_monitoring is not None:
         monitor_dependencies = []
         if workflow.job_pre_start is not None:
@@ -194,22 +393,23 @@ def _generate_execution_template(workflow: Workflow):
     return {"name": "execution", "dag": {"tasks": tasks}}
 
 
-def _generate_steps_templates(workflow) -> List[Dict[str, Any]]:
+def _generate_steps_templates(
+    workflow, env_secret: Optional[str]
+) -> List[Dict[str, Any]]:
     templates = []
+    execution_deadline = _get_execution_deadline(workflow)
 
     if workflow.job_pre_start is not None:
         template_pre_start = {
             "name": "pre-start",
-            "nodeSelector": {"group": "load-tests-workers-slave"},
-            "activeDeadlineSeconds": 600,
+            "nodeSelector": {"group": SLAVES_GROUP},
+            "activeDeadlineSeconds": STEP_DEADLINE_SECONDS,
             "container": {
                 "image": "{{workflow.outputs.parameters.image}}",
                 "command": ["python", "-m", "bolt_run", "pre_start"],
                 "env": [
                     *_map_envs(workflow.job_pre_start.env_vars),
-                    {"name": "BOLT_EXECUTION_ID", "value": workflow.execution_id},
-                    {"name": "BOLT_GRAPHQL_URL", "value": GRAPHQL_URL},
-                    {"name": "BOLT_HASURA_TOKEN", "value": workflow.auth_token},
+                    *_common_envs(workflow, env_secret),
                     {"name": "BOLT_USERS", "value": str(workflow.job_load_tests.users)},
                 ],
                 "resources": {
@@ -223,17 +423,15 @@ def _generate_steps_templates(workflow) -> List[Dict[str, Any]]:
     if workflow.job_post_stop is not None:
         template_post_stop = {
             "name": "post-stop",
-            "nodeSelector": {"group": "load-tests-workers-slave"},
+            "nodeSelector": {"group": SLAVES_GROUP},
             "metadata": {"labels": {"prevent-bolt-termination": "true"}},
-            "activeDeadlineSeconds": 600,
+            "activeDeadlineSeconds": STEP_DEADLINE_SECONDS,
             "container": {
                 "image": "{{workflow.outputs.parameters.image}}",
                 "command": ["python", "-m", "bolt_run", "post_stop"],
                 "env": [
                     *_map_envs(workflow.job_post_stop.env_vars),
-                    {"name": "BOLT_EXECUTION_ID", "value": workflow.execution_id},
-                    {"name": "BOLT_GRAPHQL_URL", "value": GRAPHQL_URL},
-                    {"name": "BOLT_HASURA_TOKEN", "value": workflow.auth_token},
+                    *_common_envs(workflow, env_secret),
                 ],
                 "resources": {
                     "limits": {"cpu": "110m", "memory": "220Mi"},
@@ -246,16 +444,15 @@ def _generate_steps_templates(workflow) -> List[Dict[str, Any]]:
     if workflow.job_monitoring is not None:
         template_monitoring = {
             "name": "monitoring",
-            "nodeSelector": {"group": "load-tests-workers-slave"},
+            "nodeSelector": {"group": SLAVES_GROUP},
+            "activeDeadlineSeconds": execution_deadline,
             "retryStrategy": {"limit": 10},
             "container": {
                 "image": "{{workflow.outputs.parameters.image}}",
                 "command": ["python", "-m", "bolt_run", "monitoring"],
                 "env": [
                     *_map_envs(workflow.job_monitoring.env_vars),
-                    {"name": "BOLT_EXECUTION_ID", "value": workflow.execution_id},
-                    {"name": "BOLT_GRAPHQL_URL", "value": GRAPHQL_URL},
-                    {"name": "BOLT_HASURA_TOKEN", "value": workflow.auth_token},
+                    *_common_envs(workflow, env_secret),
                 ],
                 "resources": {
                     "limits": {"cpu": "110m", "memory": "220Mi"},
@@ -268,51 +465,50 @@ def _generate_steps_templates(workflow) -> List[Dict[str, Any]]:
     if workflow.job_load_tests is not None:
         template_load_tests_master = {
             "name": "load-tests-master",
+            "inputs": {"parameters": [{"name": "master-index"}, {"name": "slaves"}]},
             "daemon": True,
-            "nodeSelector": {"group": "load-tests-workers-master"},
-            "activeDeadlineSeconds": 30000,
+            "nodeSelector": {"group": MASTERS_GROUP},
+            "activeDeadlineSeconds": execution_deadline,
             "container": {
                 "image": "{{workflow.outputs.parameters.image}}",
                 "command": ["python", "-m", "bolt_run", "load_tests"],
                 "env": [
-                    *_map_envs(workflow.job_load_tests.env_vars),
-                    {"name": "BOLT_EXECUTION_ID", "value": workflow.execution_id},
-                    {"name": "BOLT_GRAPHQL_URL", "value": GRAPHQL_URL},
-                    {"name": "BOLT_HASURA_TOKEN", "value": workflow.auth_token},
+                    *_load_tests_envs(workflow, env_secret),
                     {"name": "BOLT_WORKER_TYPE", "value": "master"},
+                    # masters of a sharded load test tell themselves apart by it
+                    {
+                        "name": "BOLT_MASTER_INDEX",
+                        "value": "{{inputs.parameters.master-index}}",
+                    },
+                    {
+                        "name": "BOLT_EXPECTED_SLAVES",
+                        "value": "{{inputs.parameters.slaves}}",
+                    },
                 ],
-                "resources": {
-                    "limits": {"cpu": "410m", "memory": "520Mi"},
-                    "requests": {"cpu": "400m", "memory": "500Mi"},
-                },
+                "resources": MASTER_PROFILE.to_resources(),
             },
         }
         templates.append(template_load_tests_master)
 
         template_load_tests_slave = {
             "name": "load-tests-slave",
-            "inputs": {"parameters": [{"name": "master-ip"}]},
-            "nodeSelector": {"group": "load-tests-workers-slave"},
+            "inputs": {"parameters": [{"name": "master-ip"}, {"name": "users"}]},
+            "nodeSelector": {"group": SLAVES_GROUP},
+            "activeDeadlineSeconds": execution_deadline,
             "retryStrategy": {"limit": 10},
             "container": {
                 "image": "{{workflow.outputs.parameters.image}}",
                 "command": ["python", "-m", "bolt_run", "load_tests"],
                 "env": [
-                    *_map_envs(workflow.job_load_tests.env_vars),
-                    {"name": "BOLT_EXECUTION_ID", "value": workflow.execution_id},
-                    {"name": "BOLT_GRAPHQL_URL", "value": GRAPHQL_URL},
-                    {"name": "BOLT_HASURA_TOKEN", "value": workflow.auth_token},
+                    *_load_tests_envs(workflow, env_secret),
                     {"name": "BOLT_WORKER_TYPE", "value": "slave"},
                     {
                         "name": "BOLT_MASTER_HOST",
                         "value": "{{inputs.parameters.master-ip}}",
                     },
-                    {"name": "BOLT_USERS", "value": str(workflow.job_load_tests.users)},
+                    {"name": "BOLT_USERS", "value": "{{inputs.parameters.users}}"},
                 ],
-                "resources": {
-                    "limits": {"cpu": "840m", "memory": "950Mi"},
-                    "requests": {"cpu": "800m", "memory": "900Mi"},
-                },
+                "resources": SLAVE_PROFILE.to_resources(),
             },
         }
         if workflow.job_load_tests.host is not None:
@@ -323,6 +519,9 @@ def _generate_steps_templates(workflow) -> List[Dict[str, Any]]:
             template_load_tests_slave["container"]["env"].append(
                 {"name": "BOLT_PORT", "value": str(workflow.job_load_tests.port)}
             )
+        if env_secret is not None:
+            for template in (template_load_tests_master, template_load_tests_slave):
+                template["container"]["envFrom"] = [{"secretRef": {"name": env_secret}}]
         templates.append(template_load_tests_slave)
 
     return templates
@@ -335,6 +534,62 @@ def _generate_volumes(workflow: Workflow):
     ]
 
 
+def _get_execution_deadline(workflow: Workflow) -> int:
+    return workflow.duration_seconds + settings.DEADLINE_SLACK_SECONDS
+
+
+def _get_workflow_deadline(workflow: Workflow, prepull_groups: Sequence[str]) -> int:
+    """
+    Sums up deadlines of the steps run one after another
+    """
+    deadline = settings.BUILD_DEADLINE_SECONDS + _get_execution_deadline(workflow)
+    if prepull_groups:
+        deadline += STEP_DEADLINE_SECONDS
+    if workflow.job_pre_start is not None:
+        deadline += STEP_DEADLINE_SECONDS
+    return deadline
+
+
+def _get_reaping_delay(workflow: Workflow, deadline: int) -> int:
+    """
+    The post-stop exit handler runs after the workflow deadline, it must not
+    be terminated by the reaper
+    """
+    delay = deadline + settings.REAPER_GRACE_SECONDS
+    if workflow.job_post_stop is not None:
+        delay += STEP_DEADLINE_SECONDS
+    return delay
+
+
+def _get_env_secret_name(workflow_name: str) -> str:
+    return f"{workflow_name}-env"
+
+
+def _common_envs(workflow: Workflow, env_secret: Optional[str]) -> List[Dict]:
+    names_values = [
+        ("BOLT_EXECUTION_ID", workflow.execution_id),
+        ("BOLT_GRAPHQL_URL", GRAPHQL_URL),
+        ("BOLT_HASURA_TOKEN", workflow.auth_token),
+    ]
+    if env_secret is None:
+        return [{"name": name, "value": value} for name, value in names_values]
+
+    return [
+        {"name": name, "valueFrom": {"secretKeyRef": {"name": env_secret, "key": name}}}
+        for name, _ in names_values
+    ]
+
+
+def _load_tests_envs(workflow: Workflow, env_secret: Optional[str]) -> List[Dict]:
+    # with the shared env the whole secret is loaded through envFrom
+    if env_secret is not None:
+        return []
+    return [
+        *_map_envs(workflow.job_load_tests.env_vars),
+        *_common_envs(workflow, env_secret),
+    ]
+
+
 def _postfix_generator(num=6):
     return "".join(choice(ascii_lowercase + digits) for _ in range(num))
 
@@ -0,0 +1,582 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+In-process stand-in for the Kubernetes API server serving argoproj.io Workflows
+(and the Secrets created along with them).
+
+It allows running the creator end-to-end without a cluster, e.g.
+
+    python -m src.fake_kubernetes --port 8001 --kubeconfig /tmp/kubeconfig
+
+and then pointing `KubernetesService(config_file="/tmp/kubeconfig")` at it.
+"""
+
+import argparse
+import copy
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+from src import custom_logger
+
+logger = custom_logger.setup_custom_logger(__file__)
+
+RESOURCE_PATHS = {
+    "workflows": re.compile(
+        r"^/apis/argoproj\.io/v1alpha1/namespaces/(?P<namespace>[^/]+)/workflows"
+        r"(?:/(?P<name>[^/]+))?/?$"
+    ),
+    "secrets": re.compile(
+        r"^/api/v1/namespaces/(?P<namespace>[^/]+)/secrets(?:/(?P<name>[^/]+))?/?$"
+    ),
+}
+JSON_PATCH = "application/json-patch+json"
+MERGE_PATCH = "application/merge-patch+json"
+LIST_KINDS = {
+    "workflows": ("argoproj.io/v1alpha1", "WorkflowList"),
+    "secrets": ("v1", "SecretList"),
+}
+
+
+class FakeArgoApiServer:
+    """
+    Implements create/get/list/watch/patch/delete of workflows.argoproj.io
+    and secrets. Patches are applied as JSON patches (when sent with the
+    application/json-patch+json content type) or JSON merge patches.
+    Deleting an object deletes the objects it owns, like the garbage collector.
+
+    `latency` (plus random `jitter`) is added to every request, `error_rate`
+    is the probability of answering with 500 and `rate_limit` is the number of
+    requests per second served before answering with 429. Only the last
+    `max_events` changes are kept for watches, older resource versions get 410.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit: Optional[float] = None,
+        max_events: int = 10000,
+    ):
+        self._condition = threading.Condition()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.max_events = max_events
+        self.stats = {"requests": 0, "errors": 0, "throttled": 0}
+
+        self._objects: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        # (resource version, resource, namespace, labels, encoded watch event)
+        self._events: List[Tuple[int, str, str, Dict[str, str], bytes]] = []
+        self._resource_version = 0
+        self._stopped = False
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def rate_limit(self) -> Optional[float]:
+        return self._rate_limit
+
+    @rate_limit.setter
+    def rate_limit(self, value: Optional[float]):
+        with self._condition:
+            self._rate_limit = value
+            # start with a full bucket, it holds at least one request
+            self._tokens = self._bucket_size
+            self._tokens_updated_at = time.monotonic()
+
+    @property
+    def _bucket_size(self) -> float:
+        return max(self.rate_limit or 0.0, 1.0)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Fake Kubernetes API server listening on {self.url}.")
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def write_kubeconfig(self, path: str, context: str = "fake"):
+        # JSON is valid YAML, so the kubernetes client reads it as a kubeconfig
+        kubeconfig = {
+            "apiVersion": "v1",
+            "kind": "Config",
+            "current-context": context,
+            "clusters": [{"name": context, "cluster": {"server": self.url}}],
+            "users": [{"name": context, "user": {"token": "fake"}}],
+            "contexts": [
+                {"name": context, "context": {"cluster": context, "user": context}}
+            ],
+        }
+        with open(path, "w") as f:
+            json.dump(kubeconfig, f)
+
+    def objects(
+        self, resource: str = "workflows", namespace: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        with self._condition:
+            return [
+                copy.deepcopy(obj)
+                for (obj_resource, obj_namespace, _), obj in self._objects.items()
+                if obj_resource == resource
+                and (namespace is None or obj_namespace == namespace)
+            ]
+
+    def _admit(self) -> Optional[int]:
+        """
+        Returns an HTTP status to fail the request with, if any
+        """
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        with self._condition:
+            self.stats["requests"] += 1
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._bucket_size,
+                    self._tokens + (now - self._tokens_updated_at) * self.rate_limit,
+                )
+                self._tokens_updated_at = now
+                if self._tokens < 1:
+                    self.stats["throttled"] += 1
+                    return 429
+                self._tokens -= 1
+            if random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return 500
+        return None
+
+    def _create(self, resource: str, namespace: str, body: Dict[str, Any]):
+        metadata = body.setdefault("metadata", {})
+        if not metadata.get("name") and metadata.get("generateName"):
+            metadata["name"] = metadata["generateName"] + uuid.uuid4().hex[:5]
+        name = metadata.get("name")
+        if not name:
+            return 422, _status(422, "Invalid", "metadata.name is required")
+
+        with self._condition:
+            if (resource, namespace, name) in self._objects:
+                return 409, _status(409, "AlreadyExists", f'"{name}" already exists')
+            metadata.update(
+                namespace=namespace,
+                uid=str(uuid.uuid4()),
+                creationTimestamp=datetime.now(timezone.utc).strftime(
+                    "%Y-%m-%dT%H:%M:%SZ"
+                ),
+            )
+            self._objects[(resource, namespace, name)] = body
+            self._record(resource, "ADDED", body)
+            return 201, copy.deepcopy(body)
+
+    def _patch(
+        self,
+        resource: str,
+        namespace: str,
+        name: str,
+        patch: Any,
+        content_type: str = MERGE_PATCH,
+    ):
+        patch_type = JSON_PATCH if content_type.startswith(JSON_PATCH) else MERGE_PATCH
+        if not isinstance(patch, list if patch_type == JSON_PATCH else dict):
+            return 400, _status(400, "BadRequest", f"Invalid {patch_type} body")
+        with self._condition:
+            obj = self._objects.get((resource, namespace, name))
+            if obj is None:
+                return 404, _status(404, "NotFound", f'"{name}" not found')
+            if patch_type == JSON_PATCH:
+                _json_patch(obj, patch)
+            else:
+                _merge_patch(obj, patch)
+            self._record(resource, "MODIFIED", obj)
+            return 200, copy.deepcopy(obj)
+
+    def _delete(self, resource: str, namespace: str, name: str):
+        with self._condition:
+            obj = self._objects.pop((resource, namespace, name), None)
+            if obj is None:
+                return 404, _status(404, "NotFound", f'"{name}" not found')
+            self._record(resource, "DELETED", obj)
+
+            uid = obj["metadata"]["uid"]
+            for key, dependent in list(self._objects.items()):
+                owners = dependent["metadata"].get("ownerReferences") or []
+                if any(owner.get("uid") == uid for owner in owners):
+                    self._delete(*key)
+        return 200, _status(200, "Success", f'"{name}" deleted')
+
+    def _record(self, resource: str, event_type: str, obj: Dict[str, Any]):
+        self._resource_version += 1
+        metadata = obj["metadata"]
+        metadata["resourceVersion"] = str(self._resource_version)
+        self._events.append(
+            (
+                self._resource_version,
+                resource,
+                metadata["namespace"],
+                dict(metadata.get("labels") or {}),
+                _encode_event(event_type, obj),
+            )
+        )
+        if len(self._events) > self.max_events:
+            del self._events[: len(self._events) - self.max_events]
+        self._condition.notify_all()
+
+    def _expired(self, resource_version: int) -> bool:
+        """
+        Tells whether changes after `resource_version` are no longer kept
+        """
+        with self._condition:
+            return bool(self._events) and resource_version < self._events[0][0] - 1
+
+    def _events_since(self, resource, namespace, selector, resource_version):
+        """
+        Returns encoded events newer than `resource_version`, None if expired.
+        Has to be called with the lock held.
+        """
+        if self._expired(resource_version):
+            return None
+        start = 0
+        if self._events:
+            # resource versions of kept events are consecutive
+            start = max(resource_version - self._events[0][0] + 1, 0)
+        return [
+            line
+            for _, event_resource, event_namespace, labels, line in self._events[start:]
+            if event_resource == resource
+            and event_namespace == namespace
+            and selector(labels)
+        ]
+
+    def _watch(self, resource, namespace, selector, resource_version, timeout, write):
+        """
+        Events are collected with the lock held but written without it,
+        so a slow client does not block other requests.
+        """
+        deadline = time.monotonic() + timeout
+        lines = []
+        with self._condition:
+            if resource_version is None:
+                # no resource version means: current state first, then changes
+                lines = [
+                    _encode_event("ADDED", obj)
+                    for (obj_resource, obj_namespace, _), obj in self._objects.items()
+                    if obj_resource == resource
+                    and obj_namespace == namespace
+                    and selector(obj["metadata"].get("labels") or {})
+                ]
+                resource_version = self._resource_version
+
+        while True:
+            for line in lines:
+                write(line)
+
+            with self._condition:
+                while True:
+                    lines = self._events_since(
+                        resource, namespace, selector, resource_version
+                    )
+                    remaining = deadline - time.monotonic()
+                    if lines != [] or self._stopped or remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                resource_version = self._resource_version
+
+            if lines is None:
+                status = _status(410, "Expired", "Too old resource version")
+                write(_encode_event("ERROR", status))
+                return
+            if not lines:
+                return
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def fake(self) -> FakeArgoApiServer:
+        return self.server.fake
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_POST(self):
+        resource, namespace, name, query = self._route()
+        body = self._read_body()
+        if resource is None or name is not None:
+            return self._send(404, _status(404, "NotFound", "Not found"))
+        if self._reject():
+            return
+        self._send(*self.fake._create(resource, namespace, body))
+
+    def do_GET(self):
+        resource, namespace, name, query = self._route()
+        if resource is None:
+            return self._send(404, _status(404, "NotFound", "Not found"))
+        if self._reject():
+            return
+
+        if name is not None:
+            with self.fake._condition:
+                obj = copy.deepcopy(self.fake._objects.get((resource, namespace, name)))
+            if obj is None:
+                return self._send(404, _status(404, "NotFound", f'"{name}" not found'))
+            return self._send(200, obj)
+
+        selector = _parse_label_selector(query.get("labelSelector", [""])[0])
+        if query.get("watch", ["false"])[0].lower() in ("true", "1"):
+            return self._stream_watch(resource, namespace, selector, query)
+
+        items = [
+            obj
+            for obj in self.fake.objects(resource, namespace)
+            if selector(obj["metadata"].get("labels") or {})
+        ]
+        api_version, kind = LIST_KINDS[resource]
+        self._send(
+            200,
+            {
+                "apiVersion": api_version,
+                "kind": kind,
+                "metadata": {"resourceVersion": str(self.fake._resource_version)},
+                "items": items,
+            },
+        )
+
+    def do_PATCH(self):
+        resource, namespace, name, query = self._route()
+        body = self._read_body()
+        if resource is None or name is None:
+            return self._send(404, _status(404, "NotFound", "Not found"))
+        if self._reject():
+            return
+        content_type = self.headers.get("Content-Type") or MERGE_PATCH
+        self._send(*self.fake._patch(resource, namespace, name, body, content_type))
+
+    def do_DELETE(self):
+        resource, namespace, name, query = self._route()
+        self._read_body()
+        if resource is None or name is None:
+            return self._send(404, _status(404, "NotFound", "Not found"))
+        if self._reject():
+            return
+        self._send(*self.fake._delete(resource, namespace, name))
+
+    def _route(self):
+        url = urlparse(self.path)
+        for resource, path in RESOURCE_PATHS.items():
+            match = path.match(url.path)
+            if match is not None:
+                query = parse_qs(url.query)
+                return resource, match.group("namespace"), match.group("name"), query
+        return None, None, None, {}
+
+    def _reject(self) -> bool:
+        status = self.fake._admit()
+        if status == 429:
+            self._send(
+                429, _status(429, "TooManyRequests", "Throttled"), {"Retry-After": "1"}
+            )
+        elif status is not None:
+            self._send(status, _status(status, "InternalError", "Injected error"))
+        return status is not None
+
+    def _read_body(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def _send(self, status: int, body: Dict[str, Any], headers: Optional[Dict] = None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _stream_watch(self, resource, namespace, selector, query):
+        resource_version = query.get("resourceVersion", [None])[0]
+        timeout = float(query.get("timeoutSeconds", ["30"])[0])
+        if resource_version and self.fake._expired(int(resource_version)):
+            status = _status(410, "Expired", "Too old resource version")
+            return self._send(410, status)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write(line):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+
+        try:
+            self.fake._watch(
+                resource,
+                namespace,
+                selector,
+                int(resource_version) if resource_version else None,
+                timeout,
+                write,
+            )
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+def _parse_label_selector(selector: str):
+    """
+    Supports the equality based selectors: `a=b`, `a==b`, `a!=b`, `a` and `!a`.
+    Returns a function matching labels of an object.
+    """
+    requirements = []
+    for term in filter(None, (term.strip() for term in selector.split(","))):
+        if "!=" in term:
+            key, value = term.split("!=", 1)
+            requirements.append(lambda labels, k=key, v=value: labels.get(k) != v)
+        elif "=" in term:
+            key, value = term.replace("==", "=").split("=", 1)
+            requirements.append(lambda labels, k=key, v=value: labels.get(k) == v)
+        elif term.startswith("!"):
+            requirements.append(lambda labels, k=term[1:]: k not in labels)
+        else:
+            requirements.append(lambda labels, k=term: k in labels)
+
+    def matches(labels):
+        return all(requirement(labels) for requirement in requirements)
+
+    return matches
+
+
+def _json_patch(target: Dict[str, Any], operations: List[Dict[str, Any]]):
+    """
+    Supports add, replace and remove of object members
+    """
+    for operation in operations:
+        *parents, key = operation["path"].lstrip("/").split("/")
+        parent = target
+        for parent_key in parents:
+            parent = parent.setdefault(parent_key, {})
+        if operation["op"] == "remove":
+            parent.pop(key, None)
+        else:
+            parent[key] = operation["value"]
+
+
+def _merge_patch(target: Dict[str, Any], patch: Dict[str, Any]):
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_patch(target[key], value)
+        else:
+            target[key] = value
+
+
+def _encode_event(event_type: str, obj: Dict[str, Any]) -> bytes:
+    return json.dumps({"type": event_type, "object": obj}).encode() + b"\n"
+
+
+def _status(code: int, reason: str, message: str) -> Dict[str, Any]:
+    return {
+        "apiVersion": "v1",
+        "kind": "Status",
+        "status": "Success" if code < 400 else "Failure",
+        "message": message,
+        "reason": reason,
+        "code": code,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=None)
+    parser.add_argument(
+        "--kubeconfig", help="Write a kubeconfig pointing at the server"
+    )
+    args = parser.parse_args()
+
+    server = FakeArgoApiServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+    )
+    if args.kubeconfig:
+        server.write_kubeconfig(args.kubeconfig)
+    server.start()
+    try:
+        while True:
+            time.sleep(60)
+            logger.info(f"Stats: {server.stats}")
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+import time
+from datetime import datetime
+from datetime import timezone
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Set
+from typing import Tuple
+
+from src import custom_logger
+from src import settings
+from src.argo import COMPLETED_WORKFLOWS_SELECTOR
+from src.argo import PROJECT_LABEL
+from src.argo import STEP_DEADLINE_SECONDS
+from src.argo import TENANT_LABEL
+from src.services import KubernetesServiceABC
+
+logger = custom_logger.setup_custom_logger(__file__)
+
+
+class PrePullCache:
+    """
+    Remembers images recently pre-pulled by node groups of each cluster.
+
+    Images are recorded only once their pre-pull succeeded, from the status of
+    finished pre-pull steps. The built image is only known once the workflow
+    runs, so the workflow skips the pre-pull itself when the image is one of
+    the recorded ones (see `set_prepull_skips`).
+    """
+
+    def __init__(
+        self, ttl_seconds: float = 3600, max_size: int = 1024, max_images: int = 5
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.max_images = max_images
+        # (cluster, tenant id, project id, node group, image) -> pulled at
+        self._entries: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def images(
+        self, cluster: str, tenant_id: str, project_id: str, node_group: str
+    ) -> List[str]:
+        """
+        Returns the most recently pre-pulled images of the project
+        """
+        now = time.time()
+        prefix = (cluster, tenant_id, project_id, node_group)
+        with self._lock:
+            fresh = sorted(
+                (
+                    (pulled_at, key[-1])
+                    for key, pulled_at in self._entries.items()
+                    if key[:-1] == prefix and self._is_fresh(pulled_at, now)
+                ),
+                reverse=True,
+            )
+        return [image for _, image in fresh[: self.max_images]]
+
+    def mark(
+        self,
+        cluster: str,
+        tenant_id: str,
+        project_id: str,
+        node_group: str,
+        image: str,
+        pulled_at: float,
+    ):
+        key = (cluster, tenant_id, project_id, node_group, image)
+        now = time.time()
+        with self._lock:
+            self._entries[key] = max(pulled_at, self._entries.get(key, pulled_at))
+            if len(self._entries) > self.max_size:
+                self._evict(now)
+
+    def record(self, cluster: str, workflow: Dict[str, Any]):
+        """
+        Marks node groups whose pre-pull steps of the workflow all succeeded
+        """
+        labels = workflow["metadata"].get("labels") or {}
+        status = workflow.get("status") or {}
+        image = _get_image(status)
+        if image is None or TENANT_LABEL not in labels or PROJECT_LABEL not in labels:
+            return
+
+        pulls: Dict[str, List[Dict[str, Any]]] = {}
+        for node in (status.get("nodes") or {}).values():
+            # the template has a retry strategy, so each pull is a Retry node
+            if node.get("templateName") != "prepull" or node.get("type") != "Retry":
+                continue
+            parameters = (node.get("inputs") or {}).get("parameters") or []
+            for parameter in parameters:
+                if parameter.get("name") == "group":
+                    pulls.setdefault(parameter.get("value"), []).append(node)
+
+        for group, nodes in pulls.items():
+            if all(node.get("phase") == "Succeeded" for node in nodes):
+                pulled_at = max(_parse_time(node.get("finishedAt")) for node in nodes)
+                self.mark(
+                    cluster,
+                    labels[TENANT_LABEL],
+                    labels[PROJECT_LABEL],
+                    group,
+                    image,
+                    pulled_at,
+                )
+
+    def _is_fresh(self, pulled_at: float, now: float) -> bool:
+        return now - pulled_at < self.ttl_seconds
+
+    def _evict(self, now: float):
+        self._entries = {
+            key: pulled_at
+            for key, pulled_at in self._entries.items()
+            if self._is_fresh(pulled_at, now)
+        }
+        while len(self._entries) > self.max_size:
+            del self._entries[min(self._entries, key=self._entries.get)]
+
+
+class PrePullWatcher:
+    """
+    Periodically records pre-pulls of workflows completed in every cluster.
+    Only metadata of completed workflows is listed, each workflow is fetched
+    whole once, unless it was created too long ago for its pre-pull to be fresh.
+    """
+
+    def __init__(
+        self,
+        kubernetes_service: KubernetesServiceABC,
+        cache: PrePullCache,
+        interval_seconds: float = 30,
+    ):
+        self.kubernetes_service = kubernetes_service
+        self.cache = cache
+        self.interval_seconds = interval_seconds
+        # cluster -> uids of workflows already recorded
+        self._recorded: Dict[str, Set[str]] = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info("Pre-pull watcher started.")
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def watch(self):
+        for cluster, service in self.kubernetes_service.clusters().items():
+            try:
+                workflows = service.list_argo_workflow_metadata(
+                    COMPLETED_WORKFLOWS_SELECTOR
+                )
+            except Exception as e:
+                logger.error(f"Failed to list workflows in {cluster}: {e}")
+                continue
+            self._recorded[cluster] = self._record(cluster, service, workflows)
+
+    def _record(self, cluster, service, workflows) -> Set[str]:
+        # pre-pulls finish within the build and pre-pull deadlines after creation
+        created_after = time.time() - (
+            self.cache.ttl_seconds
+            + settings.BUILD_DEADLINE_SECONDS
+            + STEP_DEADLINE_SECONDS
+        )
+        recorded = self._recorded.get(cluster, set())
+        output = set()
+        for workflow in workflows:
+            metadata = workflow["metadata"]
+            if metadata["uid"] in recorded:
+                output.add(metadata["uid"])
+                continue
+            if _parse_time(metadata.get("creationTimestamp")) < created_after:
+                continue
+
+            try:
+                self.cache.record(cluster, service.get_argo_workflow(metadata["name"]))
+            except Exception as e:
+                logger.error(f"Failed to record pre-pulls of {metadata['name']}: {e}")
+                continue
+            output.add(metadata["uid"])
+        # uids of deleted workflows are dropped
+        return output
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_seconds):
+            self.watch()
+
+
+def _get_image(status: Dict[str, Any]):
+    for parameter in (status.get("outputs") or {}).get("parameters") or []:
+        if parameter.get("name") == "image":
+            return parameter.get("value")
+    return None
+
+
+def _parse_time(value) -> float:
+    if not value:
+        return time.time()
+    parsed = datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
@@ -0,0 +1,152 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import abc
+import collections
+import sys
+import threading
+import time
+import tracemalloc
+from types import CodeType
+from types import FrameType
+from typing import Optional
+
+from src import custom_logger
+
+logger = custom_logger.setup_custom_logger(__file__)
+
+
+class ProfilerABC(abc.ABC):
+    """
+    Captures a profile in the background for the given number of seconds,
+    so the profiled process keeps serving requests meanwhile.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._result = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def result(self) -> Optional[bytes]:
+        return self._result
+
+    def start(self, seconds: float) -> bool:
+        """
+        Returns False when a profile is already being captured
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self._result = None
+            self._thread = threading.Thread(
+                target=self._capture_safely, args=(seconds,), daemon=True
+            )
+            self._thread.start()
+        return True
+
+    def _capture_safely(self, seconds: float):
+        logger.info(f"Capturing {type(self).__name__} profile for {seconds}s.")
+        try:
+            self._result = self._capture(seconds)
+        except Exception as e:
+            logger.error(f"Failed to capture profile: {e}")
+            self._result = f"Failed to capture profile: {e}\n".encode()
+
+    @abc.abstractmethod
+    def _capture(self, seconds: float) -> bytes:
+        ...
+
+
+class CpuProfiler(ProfilerABC):
+    """
+    Samples stacks of all threads and returns them in the folded format
+    (`frame;frame;frame count` per line), ready for flamegraph.pl or speedscope.
+    With `focus` only samples with the given code object on the stack are kept.
+    """
+
+    def __init__(self, interval: float = 0.005, focus: Optional[CodeType] = None):
+        super().__init__()
+        self.interval = interval
+        self.focus = focus
+
+    def _capture(self, seconds):
+        stacks = collections.Counter()
+        own_ident = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = self._get_stack(frame)
+                if stack is not None:
+                    stacks[stack] += 1
+            time.sleep(self.interval)
+
+        return "".join(
+            f"{stack} {count}\n" for stack, count in stacks.most_common()
+        ).encode()
+
+    def _get_stack(self, frame: FrameType) -> Optional[str]:
+        frames = []
+        focused = self.focus is None
+        while frame is not None:
+            code = frame.f_code
+            focused = focused or code is self.focus
+            frames.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if not focused:
+            return None
+        return ";".join(reversed(frames))
+
+
+class MemoryProfiler(ProfilerABC):
+    """
+    Traces allocations with tracemalloc and returns the top allocation sites
+    of the memory still allocated at the end of the capture.
+    """
+
+    def __init__(self, limit: int = 50, frames: int = 10):
+        super().__init__()
+        self.limit = limit
+        self.frames = frames
+
+    def _capture(self, seconds):
+        already_tracing = tracemalloc.is_tracing()
+        if not already_tracing:
+            tracemalloc.start(self.frames)
+        try:
+            time.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if not already_tracing:
+                tracemalloc.stop()
+
+        snapshot = snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        lines = [f"Top {self.limit} allocation sites:"]
+        for stat in snapshot.statistics("traceback")[: self.limit]:
+            lines.append(f"{stat.size / 1024:.1f} KiB in {stat.count} blocks")
+            lines.extend(f"    {line}" for line in stat.traceback.format())
+        return ("\n".join(lines) + "\n").encode()
@@ -0,0 +1,121 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+import time
+from typing import List
+
+from src import custom_logger
+from src.argo import DEADLINE_ANNOTATION
+from src.argo import RUNNING_WORKFLOWS_SELECTOR
+from src.services import KubernetesServiceABC
+
+logger = custom_logger.setup_custom_logger(__file__)
+
+
+class WorkflowReaper:
+    """
+    Terminates running workflows submitted by the creator once their deadline
+    annotation has passed, in case Argo did not enforce activeDeadlineSeconds
+    (e.g. it was raised by hand). Termination is carried out by the Argo
+    controller, so workflows still running `delete_after_seconds` later
+    (e.g. the controller is down) are deleted, their pods are then removed by
+    the Kubernetes garbage collector. Workflows running their exit handler are
+    only left alone until then. Each cluster is reaped separately, so an
+    unreachable cluster does not stop reaping of the others.
+    """
+
+    def __init__(
+        self,
+        kubernetes_service: KubernetesServiceABC,
+        interval_seconds: float = 60,
+        delete_after_seconds: float = 300,
+    ):
+        self.kubernetes_service = kubernetes_service
+        self.interval_seconds = interval_seconds
+        self.delete_after_seconds = delete_after_seconds
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info("Workflow reaper started.")
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def reap(self) -> List[str]:
+        """
+        Returns names of the terminated or deleted workflows
+        """
+        terminated = []
+        for cluster, service in self.kubernetes_service.clusters().items():
+            try:
+                workflows = service.list_argo_workflows(RUNNING_WORKFLOWS_SELECTOR)
+            except Exception as e:
+                logger.error(f"Failed to list workflows in {cluster}: {e}")
+                continue
+            terminated.extend(self._reap_cluster(cluster, service, workflows))
+        return terminated
+
+    def _reap_cluster(self, cluster, service, workflows) -> List[str]:
+        now = time.time()
+        reaped = []
+        for workflow in workflows:
+            metadata = workflow["metadata"]
+            deadline = (metadata.get("annotations") or {}).get(DEADLINE_ANNOTATION)
+            if deadline is None or int(deadline) > now:
+                continue
+
+            name = metadata["name"]
+            if int(deadline) + self.delete_after_seconds <= now:
+                logger.info(f"Deleting workflow {name} in {cluster}, not terminated.")
+                reap = service.delete_argo_workflow
+            elif not _is_exiting(workflow):
+                logger.info(
+                    f"Terminating workflow {name} in {cluster}, deadline passed."
+                )
+                reap = service.terminate_argo_workflow
+            else:
+                continue
+            try:
+                reap(name)
+            except Exception as e:
+                logger.error(f"Failed to reap workflow {name} in {cluster}: {e}")
+                continue
+            reaped.append(name)
+        return reaped
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_seconds):
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"Failed to reap workflows: {e}")
+
+
+def _is_exiting(workflow) -> bool:
+    nodes = ((workflow.get("status") or {}).get("nodes") or {}).values()
+    return any(
+        node.get("name", "").endswith(".onExit") and node.get("phase") == "Running"
+        for node in nodes
+    )
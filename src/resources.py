@@ -17,10 +17,19 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import hmac
+from functools import partial
+from typing import Optional
+
 import falcon
 
 from src import custom_logger
 from src.argo import create_argo_workflow
+from src.argo import create_env_secret
+from src.argo import get_node_groups
+from src.argo import set_prepull_skips
+from src.prepull import PrePullCache
+from src.profiling import ProfilerABC
 from src.schemas import WorkflowSchema
 from src.services import KubernetesServiceABC
 
@@ -34,8 +43,15 @@ class HealthCheckResource:
 
 
 class WorkflowsResource:
-    def __init__(self, kubernetes_service: KubernetesServiceABC):
+    def __init__(
+        self,
+        kubernetes_service: KubernetesServiceABC,
+        shared_env=False,
+        prepull_cache: Optional[PrePullCache] = None,
+    ):
         self.kubernetes_service = kubernetes_service
+        self.shared_env = shared_env
+        self.prepull_cache = prepull_cache
 
     def on_post(self, request: falcon.Request, response: falcon.Response):
         schema = WorkflowSchema()
@@ -48,11 +64,72 @@ class WorkflowsResource:
             raise falcon.HTTPBadRequest(result.errors)
 
         workflow = result.data
-        argo_workflow = create_argo_workflow(workflow)
+        prepull_groups = []
+        prepare = None
+        if self.prepull_cache is not None:
+            prepull_groups = get_node_groups(workflow)
+            prepare = partial(self._skip_prepulled, workflow, prepull_groups)
+        argo_workflow = create_argo_workflow(workflow, self.shared_env, prepull_groups)
+        env_secret = (
+            create_env_secret(workflow, argo_workflow) if self.shared_env else None
+        )
 
         logger.info(f"Creating argo workflow in the kubernetes service.")
-        output = self.kubernetes_service.create_argo_workflow(argo_workflow)
+        output = self.kubernetes_service.create_argo_workflow(
+            argo_workflow, env_secret, prepare
+        )
         logger.info(f"The argo workflow has been created successfully.")
 
         response.media = output["metadata"]
         response.status = falcon.HTTP_OK
+
+    def _skip_prepulled(self, workflow, groups, argo_workflow, cluster):
+        images = {
+            group: self.prepull_cache.images(
+                cluster, workflow.tenant_id, workflow.project_id, group
+            )
+            for group in groups
+        }
+        set_prepull_skips(argo_workflow, images)
+
+
+def _authorize(request: falcon.Request, response, resource, params):
+    expected = f"Bearer {resource.token}"
+    if not hmac.compare_digest((request.auth or "").encode(), expected.encode()):
+        raise falcon.HTTPUnauthorized("Invalid token")
+
+
+class ProfileResource:
+    """
+    POST starts capturing a profile for `seconds` (query param) in the background,
+    GET downloads the last captured profile.
+    """
+
+    max_seconds = 300
+
+    def __init__(self, profiler: ProfilerABC, name: str, token: str):
+        self.profiler = profiler
+        self.name = name
+        self.token = token
+
+    @falcon.before(_authorize)
+    def on_post(self, request: falcon.Request, response: falcon.Response):
+        seconds = request.get_param_as_int(
+            "seconds", min_value=1, max_value=self.max_seconds, default=30
+        )
+        if not self.profiler.start(seconds):
+            raise falcon.HTTPConflict("Profile is already being captured")
+
+        response.media = {"status": "capturing", "seconds": seconds}
+        response.status = falcon.HTTP_ACCEPTED
+
+    @falcon.before(_authorize)
+    def on_get(self, request: falcon.Request, response: falcon.Response):
+        if self.profiler.running:
+            raise falcon.HTTPConflict("Profile is still being captured")
+        if self.profiler.result is None:
+            raise falcon.HTTPNotFound(description="No profile has been captured")
+
+        response.content_type = "text/plain"
+        response.downloadable_as = f"{self.name}.txt"
+        response.data = self.profiler.result
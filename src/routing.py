@@ -0,0 +1,184 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import abc
+import bisect
+import hashlib
+import threading
+import time
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from src import custom_logger
+from src.argo import RUNNING_WORKFLOWS_SELECTOR
+from src.argo import TENANT_LABEL
+
+if TYPE_CHECKING:
+    from src.services import KubernetesServiceABC
+
+logger = custom_logger.setup_custom_logger(__file__)
+
+
+def get_tenant_id(body: Dict[str, Any]) -> Optional[str]:
+    return body.get("metadata", {}).get("labels", {}).get(TENANT_LABEL)
+
+
+class RoutingPolicyABC(abc.ABC):
+    @abc.abstractmethod
+    def order(
+        self, body: Dict[str, Any], services: Dict[str, "KubernetesServiceABC"]
+    ) -> List[str]:
+        """
+        Returns names of clusters in the order they should be tried,
+        the first one is the preferred cluster, the rest are used for failover
+        """
+
+    def submitted(self, cluster: str):
+        """
+        Called once the workflow has been accepted by the given cluster
+        """
+
+
+class ConsistentHashingPolicy(RoutingPolicyABC):
+    """
+    Places tenants on a hash ring, so a tenant keeps landing on the same cluster
+    and only a small share of tenants moves when a cluster is added or removed.
+    """
+
+    def __init__(self, replicas: int = 100):
+        self.replicas = replicas
+        self._rings: Dict[Tuple[str, ...], Tuple[List[int], List[str]]] = {}
+
+    def order(self, body, services):
+        clusters = tuple(sorted(services))
+        hashes, owners = self._get_ring(clusters)
+        tenant_id = get_tenant_id(body) or body["metadata"]["name"]
+
+        output = []
+        start = bisect.bisect(hashes, self._hash(tenant_id))
+        for i in range(len(hashes)):
+            owner = owners[(start + i) % len(hashes)]
+            if owner not in output:
+                output.append(owner)
+                if len(output) == len(clusters):
+                    break
+        return output
+
+    def _get_ring(self, clusters):
+        if clusters not in self._rings:
+            points = sorted(
+                (self._hash(f"{cluster}#{i}"), cluster)
+                for cluster in clusters
+                for i in range(self.replicas)
+            )
+            self._rings[clusters] = ([h for h, _ in points], [c for _, c in points])
+        return self._rings[clusters]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int(hashlib.md5(key.encode()).hexdigest(), 16)
+
+
+class LeastLoadedPolicy(RoutingPolicyABC):
+    """
+    Prefers clusters running the smallest number of workflows. Counts are
+    cached for `cache_seconds` and bumped locally after each submission.
+    Unreachable clusters are cached too, so submissions do not wait for them
+    longer than `timeout_seconds` once per `cache_seconds`.
+    """
+
+    def __init__(self, cache_seconds: float = 30, timeout_seconds: float = 5):
+        self.cache_seconds = cache_seconds
+        self.timeout_seconds = timeout_seconds
+        self._counts: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def order(self, body, services):
+        loads = {
+            name: self._get_load(name, service) for name, service in services.items()
+        }
+        return sorted(services, key=lambda name: (loads[name], name))
+
+    def submitted(self, cluster):
+        with self._lock:
+            if cluster in self._counts:
+                fetched_at, count = self._counts[cluster]
+                self._counts[cluster] = (fetched_at, count + 1)
+
+    def _get_load(self, name, service) -> float:
+        with self._lock:
+            cached = self._counts.get(name)
+        if cached is not None and time.monotonic() - cached[0] < self.cache_seconds:
+            return cached[1]
+
+        try:
+            count = service.count_argo_workflows(
+                RUNNING_WORKFLOWS_SELECTOR, self.timeout_seconds
+            )
+        except Exception as e:
+            logger.error(f"Failed to count running workflows in {name}: {e}")
+            # an unreachable cluster goes last, it is still tried on failover
+            count = float("inf")
+
+        with self._lock:
+            self._counts[name] = (time.monotonic(), count)
+        return count
+
+
+class PinnedPolicy(RoutingPolicyABC):
+    """
+    Sends tenants listed in `pins` to their cluster, everything else
+    (and failover) is decided by the `fallback` policy.
+    """
+
+    def __init__(self, pins: Dict[str, str], fallback: RoutingPolicyABC):
+        self.pins = pins
+        self.fallback = fallback
+
+    def order(self, body, services):
+        output = self.fallback.order(body, services)
+        pinned = self.pins.get(get_tenant_id(body))
+        if pinned in services:
+            output.remove(pinned)
+            output.insert(0, pinned)
+        elif pinned is not None:
+            logger.error(f"Tenant pinned to unknown cluster {pinned}, ignoring.")
+        return output
+
+    def submitted(self, cluster):
+        self.fallback.submitted(cluster)
+
+
+def create_routing_policy(
+    name: str, pins: Optional[Dict[str, str]] = None, cache_seconds: float = 30
+) -> RoutingPolicyABC:
+    if name == "consistent-hashing":
+        policy = ConsistentHashingPolicy()
+    elif name == "least-loaded":
+        policy = LeastLoadedPolicy(cache_seconds)
+    else:
+        raise ValueError(f"Unknown routing policy: {name}")
+
+    if pins:
+        policy = PinnedPolicy(pins, policy)
+    return policy
@@ -19,29 +19,113 @@
 
 import abc
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import List
+from typing import Optional
 
 from kubernetes import client
 from kubernetes import config
+from kubernetes.client.rest import ApiException
 from kubernetes.config import ConfigException
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.exceptions import MaxRetryError
 
 from src import custom_logger
+from src.routing import RoutingPolicyABC
 
 logger = custom_logger.setup_custom_logger(__file__)
 
+# Statuses returned before the API server accepted the request
+FAILOVER_STATUSES = {429, 502, 503}
+# Asks for metadata only, servers which do not support it return whole objects
+METADATA_ONLY_ACCEPT = ", ".join(
+    [
+        "application/json;as=PartialObjectMetadataList;v=v1;g=meta.k8s.io",
+        "application/json;as=PartialObjectMetadataList;v=v1beta1;g=meta.k8s.io",
+        "application/json",
+    ]
+)
+
+
+class RollbackError(Exception):
+    """
+    The workflow could not be deleted after a failed submission, it may still
+    run in the cluster, so it must not be submitted anywhere else.
+    """
+
 
 class KubernetesServiceABC(abc.ABC):
     @abc.abstractmethod
-    def create_argo_workflow(self, body=Dict[str, Any]):
+    def create_argo_workflow(
+        self,
+        body=Dict[str, Any],
+        env_secret: Optional[Dict[str, Any]] = None,
+        prepare: Optional[Callable[[Dict[str, Any], str], None]] = None,
+    ):
+        """
+        Creates the workflow and, if given, the secret with its env vars.
+        The secret is created first and then owned by the workflow,
+        so it is deleted together with it.
+        `prepare(body, cluster)` adjusts the workflow to the cluster it is
+        about to be submitted to.
+        """
+
+    @abc.abstractmethod
+    def list_argo_workflows(
+        self, label_selector: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        ...
+
+    @abc.abstractmethod
+    def get_argo_workflow(self, name: str) -> Dict[str, Any]:
         ...
 
+    @abc.abstractmethod
+    def terminate_argo_workflow(self, name: str):
+        ...
+
+    @abc.abstractmethod
+    def delete_argo_workflow(self, name: str):
+        ...
+
+    def list_argo_workflow_metadata(
+        self, label_selector: Optional[str] = None, timeout: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Lists workflows without their spec and status, where the cluster can
+        """
+        return self.list_argo_workflows(label_selector)
+
+    def count_argo_workflows(
+        self, label_selector: Optional[str] = None, timeout: Optional[float] = None
+    ) -> int:
+        return len(self.list_argo_workflow_metadata(label_selector, timeout))
+
+    def clusters(self) -> Dict[str, "KubernetesServiceABC"]:
+        """
+        Returns services of the single clusters by cluster name
+        """
+        return {"default": self}
+
 
 class KubernetesService(KubernetesServiceABC):
     namespace = "argo"
 
-    def __init__(self):
-        self._load_config()
-        self._cr_cli = client.CustomObjectsApi()
+    def __init__(
+        self, context: Optional[str] = None, config_file: Optional[str] = None
+    ):
+        self.name = context or "default"
+        api_client = None
+        if context is None and config_file is None:
+            self._load_config()
+        else:
+            api_client = config.new_client_from_config(
+                config_file=config_file, context=context
+            )
+            logger.info(f"Kubernetes config loaded for context {context}.")
+        self._cr_cli = client.CustomObjectsApi(api_client)
+        self._core_cli = client.CoreV1Api(api_client)
 
     def _load_config(self):
         try:
@@ -62,11 +146,228 @@ class KubernetesService(KubernetesServiceABC):
             logger.info("Kubernetes config loaded from kube-config file.")
             return
 
-    def create_argo_workflow(self, body=Dict[str, Any]):
-        return self._cr_cli.create_namespaced_custom_object(
+    def create_argo_workflow(self, body=Dict[str, Any], env_secret=None, prepare=None):
+        if prepare is not None:
+            prepare(body, self.name)
+        if env_secret is not None:
+            # created first, the workflow starts its pods right away
+            self._core_cli.create_namespaced_secret(self.namespace, env_secret)
+            secret_name = env_secret["metadata"]["name"]
+
+        try:
+            output = self._cr_cli.create_namespaced_custom_object(
+                group="argoproj.io",
+                version="v1alpha1",
+                namespace=self.namespace,
+                plural="workflows",
+                body=body,
+            )
+        except Exception as e:
+            # the workflow may have been created anyway, it needs the secret then
+            if env_secret is not None and _is_not_created(e):
+                self._roll_back(self._delete_secret, secret_name)
+            raise
+        if env_secret is None:
+            return output
+
+        metadata = output["metadata"]
+        owner_reference = {
+            "apiVersion": output["apiVersion"],
+            "kind": output["kind"],
+            "name": metadata["name"],
+            "uid": metadata["uid"],
+        }
+        try:
+            self._core_cli.patch_namespaced_secret(
+                secret_name,
+                self.namespace,
+                [
+                    {
+                        "op": "add",
+                        "path": "/metadata/ownerReferences",
+                        "value": [owner_reference],
+                    }
+                ],
+            )
+        except Exception as e:
+            # the secret would outlive the workflow, with the token in it
+            logger.error("Failed to set the env secret owner, deleting both.")
+            if not self._roll_back(self.delete_argo_workflow, metadata["name"]):
+                raise RollbackError(
+                    f"Workflow {metadata['name']} may be left without its owner."
+                ) from e
+            self._roll_back(self._delete_secret, secret_name)
+            raise
+        return output
+
+    def terminate_argo_workflow(self, name: str):
+        # the same what `argo terminate` does
+        return self._cr_cli.patch_namespaced_custom_object(
+            group="argoproj.io",
+            version="v1alpha1",
+            namespace=self.namespace,
+            plural="workflows",
+            name=name,
+            body={"spec": {"activeDeadlineSeconds": 0}},
+        )
+
+    def _delete_secret(self, name: str):
+        return self._core_cli.delete_namespaced_secret(name, self.namespace)
+
+    @staticmethod
+    def _roll_back(delete, name: str) -> bool:
+        """
+        Returns False when the object may still exist, failures are only logged
+        so they do not hide the original error
+        """
+        try:
+            delete(name)
+        except Exception as e:
+            if isinstance(e, ApiException) and e.status == 404:
+                return True
+            logger.error(f"Failed to delete {name} while rolling back: {e}")
+            return False
+        return True
+
+    def clusters(self):
+        return {self.name: self}
+
+    def delete_argo_workflow(self, name: str):
+        return self._cr_cli.delete_namespaced_custom_object(
+            group="argoproj.io",
+            version="v1alpha1",
+            namespace=self.namespace,
+            plural="workflows",
+            name=name,
+            body=client.V1DeleteOptions(),
+        )
+
+    def get_argo_workflow(self, name: str):
+        return self._cr_cli.get_namespaced_custom_object(
+            group="argoproj.io",
+            version="v1alpha1",
+            namespace=self.namespace,
+            plural="workflows",
+            name=name,
+        )
+
+    def list_argo_workflow_metadata(self, label_selector=None, timeout=None):
+        # statuses of workflows are big and often not needed
+        output = self._cr_cli.api_client.call_api(
+            "/apis/{group}/{version}/namespaces/{namespace}/{plural}",
+            "GET",
+            {
+                "group": "argoproj.io",
+                "version": "v1alpha1",
+                "namespace": self.namespace,
+                "plural": "workflows",
+            },
+            [("labelSelector", label_selector or "")],
+            {"Accept": METADATA_ONLY_ACCEPT},
+            response_type="object",
+            auth_settings=["BearerToken"],
+            _return_http_data_only=True,
+            _request_timeout=timeout,
+        )
+        return output["items"]
+
+    def list_argo_workflows(self, label_selector=None):
+        output = self._cr_cli.list_namespaced_custom_object(
             group="argoproj.io",
             version="v1alpha1",
             namespace=self.namespace,
             plural="workflows",
-            body=body,
+            label_selector=label_selector or "",
         )
+        return output["items"]
+
+
+class MultiClusterKubernetesService(KubernetesServiceABC):
+    """
+    Spreads workflows over several clusters. The routing policy decides the order
+    in which clusters are tried. The next cluster is used only when the failure
+    proves the workflow was not created, otherwise the same load test could end
+    up running on two clusters.
+    """
+
+    def __init__(
+        self,
+        services: Dict[str, KubernetesServiceABC],
+        routing_policy: RoutingPolicyABC,
+    ):
+        if not services:
+            raise ValueError("At least one cluster is required.")
+        self.services = services
+        self.routing_policy = routing_policy
+
+    @classmethod
+    def from_contexts(cls, contexts: List[str], routing_policy: RoutingPolicyABC):
+        services = {context: KubernetesService(context) for context in contexts}
+        return cls(services, routing_policy)
+
+    def create_argo_workflow(self, body=Dict[str, Any], env_secret=None, prepare=None):
+        error = None
+        for cluster in self.routing_policy.order(body, self.services):
+            logger.info(f"Submitting argo workflow to cluster {cluster}.")
+            if prepare is not None:
+                prepare(body, cluster)
+            try:
+                output = self.services[cluster].create_argo_workflow(body, env_secret)
+            except Exception as e:
+                logger.error(f"Failed to submit argo workflow to {cluster}: {e}")
+                if not _is_safe_to_fail_over(e):
+                    raise
+                error = e
+                continue
+            self.routing_policy.submitted(cluster)
+            return output
+        raise error
+
+    def clusters(self):
+        return dict(self.services)
+
+    def list_argo_workflows(self, label_selector=None):
+        # an unreachable cluster must not hide workflows of the others
+        output = []
+        for cluster, service in self.services.items():
+            try:
+                output.extend(service.list_argo_workflows(label_selector))
+            except Exception as e:
+                logger.error(f"Failed to list workflows in {cluster}: {e}")
+        return output
+
+    def get_argo_workflow(self, name: str):
+        return self._find(name, "get_argo_workflow")
+
+    def terminate_argo_workflow(self, name: str):
+        return self._find(name, "terminate_argo_workflow")
+
+    def delete_argo_workflow(self, name: str):
+        return self._find(name, "delete_argo_workflow")
+
+    def _find(self, name: str, method: str):
+        # the workflow lives in one of the clusters, others answer with 404
+        for cluster, service in self.services.items():
+            try:
+                return getattr(service, method)(name)
+            except Exception as e:
+                # an unreachable cluster must not stop the lookup
+                if not isinstance(e, ApiException) or e.status != 404:
+                    logger.error(f"{method} of {name} failed in {cluster}: {e}")
+        raise ApiException(status=404, reason=f"Workflow {name} not found")
+
+
+def _is_not_created(error: Exception) -> bool:
+    # the API server rejects invalid or conflicting objects with 4xx
+    if isinstance(error, ApiException) and 400 <= error.status < 500:
+        return True
+    return _is_safe_to_fail_over(error)
+
+
+def _is_safe_to_fail_over(error: Exception) -> bool:
+    if isinstance(error, ApiException):
+        return error.status in FAILOVER_STATUSES
+    if isinstance(error, MaxRetryError):
+        error = error.reason
+    # covers connection refused too, nothing has been sent to the cluster
+    return isinstance(error, ConnectTimeoutError)
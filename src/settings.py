@@ -0,0 +1,69 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+
+
+def _get_bool(name, default="false"):
+    return os.environ.get(name, default).lower() in ("1", "true", "yes")
+
+
+def _get_list(name, default=""):
+    value = os.environ.get(name, default)
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+# Kubeconfig contexts of the clusters workflows are submitted to. When empty,
+# a single cluster is used (in-cluster config or the current kubeconfig context).
+KUBE_CONTEXTS = _get_list("BOLT_KUBE_CONTEXTS")
+# One of: "consistent-hashing", "least-loaded"
+ROUTING_POLICY = os.environ.get("BOLT_ROUTING_POLICY", "consistent-hashing")
+# Pins tenants to clusters, e.g. "tenant-a=cluster-1,tenant-b=cluster-2"
+ROUTING_PINS = dict(item.split("=", 1) for item in _get_list("BOLT_ROUTING_PINS"))
+# How long cached running-workflow counts are trusted by the least-loaded policy
+ROUTING_LOAD_CACHE_SECONDS = int(
+    os.environ.get("BOLT_ROUTING_LOAD_CACHE_SECONDS", "30")
+)
+
+# Keep env vars shared by the workflow templates in a single per-execution Secret
+# instead of repeating them in every template
+SHARED_ENV = _get_bool("BOLT_SHARED_ENV")
+# Pull the built image onto the load test nodes before the execution starts
+PREPULL = _get_bool("BOLT_PREPULL")
+# How long nodes are assumed to keep an image after pre-pulling it
+PREPULL_CACHE_SECONDS = int(os.environ.get("BOLT_PREPULL_CACHE_SECONDS", "3600"))
+# How often finished pre-pulls are collected from the clusters
+PREPULL_WATCH_INTERVAL_SECONDS = int(
+    os.environ.get("BOLT_PREPULL_WATCH_INTERVAL_SECONDS", "30")
+)
+# Time given to the image build, builds with no_cache may take long
+BUILD_DEADLINE_SECONDS = int(os.environ.get("BOLT_BUILD_DEADLINE_SECONDS", "3600"))
+# Extra time given to load tests on top of their duration_seconds
+DEADLINE_SLACK_SECONDS = int(os.environ.get("BOLT_DEADLINE_SLACK_SECONDS", "300"))
+# Finished workflows (and their pods) are deleted after this time
+TEARDOWN_AFTER_SECONDS = int(os.environ.get("BOLT_TEARDOWN_AFTER_SECONDS", "86400"))
+# Terminate running workflows which outlived their deadline, needs the patch and
+# delete verbs on workflows
+REAPER_ENABLED = _get_bool("BOLT_REAPER_ENABLED")
+REAPER_INTERVAL_SECONDS = int(os.environ.get("BOLT_REAPER_INTERVAL_SECONDS", "60"))
+# Time given to Argo to enforce deadlines itself before the reaper steps in, and
+# to terminate the workflow before the reaper deletes it
+REAPER_GRACE_SECONDS = int(os.environ.get("BOLT_REAPER_GRACE_SECONDS", "300"))
+# Enables /debug/profile/* routes, requests have to send it as a Bearer token
+PROFILING_TOKEN = os.environ.get("BOLT_PROFILING_TOKEN") or None
@@ -0,0 +1,109 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Dict
+from typing import List
+
+
+@dataclass(frozen=True)
+class ResourceProfile:
+    requests: Dict[str, str]
+    limits: Dict[str, str]
+    # how many users (slave) or slaves (master) a single pod is able to handle
+    capacity: int
+
+    def to_resources(self) -> Dict[str, Dict[str, str]]:
+        return {"limits": dict(self.limits), "requests": dict(self.requests)}
+
+
+MASTER_PROFILE = ResourceProfile(
+    requests={"cpu": "400m", "memory": "500Mi"},
+    limits={"cpu": "410m", "memory": "520Mi"},
+    capacity=50,
+)
+SLAVE_PROFILE = ResourceProfile(
+    requests={"cpu": "800m", "memory": "900Mi"},
+    limits={"cpu": "840m", "memory": "950Mi"},
+    capacity=500,
+)
+
+
+@dataclass
+class Slave:
+    name: str
+    users: int
+
+
+@dataclass
+class Shard:
+    master: str
+    slaves: List[Slave] = field(default_factory=list)
+
+    @property
+    def users(self) -> int:
+        return sum(slave.users for slave in self.slaves)
+
+
+@dataclass
+class Topology:
+    shards: List[Shard]
+
+    @property
+    def slaves(self) -> List[Slave]:
+        return [slave for shard in self.shards for slave in shard.slaves]
+
+
+def plan_topology(
+    users: int,
+    workers: int,
+    master_profile: ResourceProfile = MASTER_PROFILE,
+    slave_profile: ResourceProfile = SLAVE_PROFILE,
+) -> Topology:
+    """
+    Splits `users` evenly across slaves. At least `workers` slaves are created,
+    more when a share would exceed the slave capacity, but never more slaves
+    than users. Slaves are grouped under as many masters as needed to keep
+    each master within its capacity.
+    """
+    slaves_count = max(workers, -(-users // slave_profile.capacity))
+    # a slave without users would only idle
+    slaves_count = min(slaves_count, max(users, 1))
+    masters_count = max(-(-slaves_count // master_profile.capacity), 1)
+
+    shards = []
+    for master_index in range(masters_count):
+        if masters_count == 1:
+            master_name = "load-tests-master"
+        else:
+            master_name = f"load-tests-master-{master_index + 1:02}"
+        shards.append(Shard(master=master_name))
+
+    for i in range(slaves_count):
+        # the first `users % slaves_count` slaves take the remainder
+        slave_users = users // slaves_count + (1 if i < users % slaves_count else 0)
+        shard = shards[i * masters_count // slaves_count]
+        if masters_count == 1:
+            slave_name = f"load-tests-slave-{i + 1:03}"
+        else:
+            slave_name = f"{shard.master}-slave-{len(shard.slaves) + 1:03}"
+        shard.slaves.append(Slave(name=slave_name, users=slave_users))
+
+    return Topology(shards=shards)
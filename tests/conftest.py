@@ -0,0 +1,52 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import pytest
+
+from src.fake_kubernetes import FakeArgoApiServer
+from src.schemas import WorkflowSchema
+from src.services import KubernetesService
+
+
+@pytest.fixture
+def workflow():
+    data = {
+        "tenant_id": "world-corp",
+        "project_id": "test-project",
+        "repository_url": "git@exmaple.git/repo/123",
+        "branch": "master",
+        "execution_id": "execution-identifier",
+        "auth_token": "some_token",
+        "duration_seconds": 123,
+        "job_load_tests": {"workers": 2, "users": 10},
+    }
+    return WorkflowSchema().load(data).data
+
+
+@pytest.fixture
+def fake_server():
+    with FakeArgoApiServer() as server:
+        yield server
+
+
+@pytest.fixture
+def kubernetes_service(fake_server, tmp_path):
+    kubeconfig = str(tmp_path / "kubeconfig")
+    fake_server.write_kubeconfig(kubeconfig)
+    return KubernetesService(config_file=kubeconfig)
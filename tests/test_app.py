@@ -18,6 +18,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import json
+import time
 from unittest.mock import create_autospec
 
 import falcon
@@ -30,17 +31,17 @@ from src.services import KubernetesServiceABC
 
 
 @pytest.fixture(scope="module")
-def kubernetes_service():
+def mock_kubernetes_service():
     return create_autospec(KubernetesServiceABC)
 
 
 @pytest.fixture
-def cli(kubernetes_service):
-    app = create_app(kubernetes_service)
+def cli(mock_kubernetes_service):
+    app = create_app(mock_kubernetes_service)
     return testing.TestClient(app)
 
 
-def test_create_workflow_1(cli, kubernetes_service):
+def test_create_workflow_1(cli, mock_kubernetes_service):
     data = {
         "tenant_id": "world-corp",
         "project_id": "test-project",
@@ -64,5 +65,47 @@ def test_create_workflow_1(cli, kubernetes_service):
 
     response: Result = cli.simulate_post("/workflows", body=json.dumps(data).encode())
 
-    kubernetes_service.create_argo_workflow.assert_called_once()
+    mock_kubernetes_service.create_argo_workflow.assert_called_once()
     assert response.status == falcon.HTTP_OK
+
+
+@pytest.fixture
+def profiling_cli(mock_kubernetes_service):
+    app = create_app(mock_kubernetes_service, profiling_token="secret")
+    return testing.TestClient(app, headers={"Authorization": "Bearer secret"})
+
+
+def test_profiling_disabled(cli):
+    response: Result = cli.simulate_post("/debug/profile/cpu")
+
+    assert response.status == falcon.HTTP_NOT_FOUND
+
+
+def test_profiling_invalid_token(profiling_cli):
+    response: Result = profiling_cli.simulate_post(
+        "/debug/profile/cpu", headers={"Authorization": "Bearer foo"}
+    )
+
+    assert response.status == falcon.HTTP_UNAUTHORIZED
+
+
+def wait_for_profile(cli, path, timeout):
+    deadline = time.monotonic() + timeout
+    response = cli.simulate_get(path)
+    while response.status == falcon.HTTP_CONFLICT and time.monotonic() < deadline:
+        time.sleep(0.05)
+        response = cli.simulate_get(path)
+    return response
+
+
+@pytest.mark.parametrize("profile", ["cpu", "memory"])
+def test_profiling_capture(profiling_cli, profile):
+    path = f"/debug/profile/{profile}"
+
+    response: Result = profiling_cli.simulate_post(path, params={"seconds": 1})
+    assert response.status == falcon.HTTP_ACCEPTED
+    assert profiling_cli.simulate_get(path).status == falcon.HTTP_CONFLICT
+
+    response = wait_for_profile(profiling_cli, path, timeout=10)
+    assert response.status == falcon.HTTP_OK
+    assert "attachment" in response.headers["content-disposition"]
@@ -0,0 +1,71 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import time
+
+from src import settings
+from src.argo import DEADLINE_ANNOTATION
+from src.argo import STEP_DEADLINE_SECONDS
+from src.argo import create_argo_workflow
+from src.dao import JobPostStop
+
+
+def test_deadlines_derived_from_duration(workflow):
+    argo_workflow = create_argo_workflow(workflow)
+
+    execution_deadline = workflow.duration_seconds + settings.DEADLINE_SLACK_SECONDS
+    spec = argo_workflow["spec"]
+    assert spec["activeDeadlineSeconds"] == (
+        settings.BUILD_DEADLINE_SECONDS + execution_deadline
+    )
+    templates = {template["name"]: template for template in spec["templates"]}
+    assert templates["load-tests-master"]["activeDeadlineSeconds"] == execution_deadline
+    assert templates["load-tests-slave"]["activeDeadlineSeconds"] == execution_deadline
+
+
+def test_deadline_annotation_leaves_room_for_post_stop(workflow):
+    workflow.job_post_stop = JobPostStop(env_vars={})
+
+    submitted_at = int(time.time())
+    argo_workflow = create_argo_workflow(workflow)
+
+    deadline = argo_workflow["spec"]["activeDeadlineSeconds"]
+    reap_at = int(argo_workflow["metadata"]["annotations"][DEADLINE_ANNOTATION])
+    assert reap_at - submitted_at >= (
+        deadline + STEP_DEADLINE_SECONDS + settings.REAPER_GRACE_SECONDS
+    )
+
+
+def test_masters_know_their_shard(workflow):
+    workflow.job_load_tests.users = 26000
+
+    argo_workflow = create_argo_workflow(workflow)
+
+    templates = {t["name"]: t for t in argo_workflow["spec"]["templates"]}
+    masters = [
+        {p["name"]: p["value"] for p in task["arguments"]["parameters"]}
+        for task in templates["execution"]["dag"]["tasks"]
+        if task["template"] == "load-tests-master"
+    ]
+    assert masters == [
+        {"master-index": "0", "slaves": "26"},
+        {"master-index": "1", "slaves": "26"},
+    ]
+    env = templates["load-tests-master"]["container"]["env"]
+    assert {"BOLT_MASTER_INDEX", "BOLT_EXPECTED_SLAVES"} <= {e["name"] for e in env}
@@ -0,0 +1,197 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+
+import pytest
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+from src.argo import RUNNING_WORKFLOWS_SELECTOR
+from src.argo import create_argo_workflow
+from src.argo import create_env_secret
+from src.fake_kubernetes import FakeArgoApiServer
+from src.routing import ConsistentHashingPolicy
+from src.routing import PinnedPolicy
+from src.services import KubernetesService
+from src.services import MultiClusterKubernetesService
+from src.services import RollbackError
+
+
+def test_create_and_list(kubernetes_service, fake_server, workflow):
+    output = kubernetes_service.create_argo_workflow(create_argo_workflow(workflow))
+
+    assert output["metadata"]["uid"]
+    assert len(fake_server.objects("workflows", "argo")) == 1
+    assert len(kubernetes_service.list_argo_workflows(RUNNING_WORKFLOWS_SELECTOR)) == 1
+    assert kubernetes_service.list_argo_workflows("foo=bar") == []
+    assert kubernetes_service.count_argo_workflows(RUNNING_WORKFLOWS_SELECTOR) == 1
+
+
+def test_shared_env_secret(kubernetes_service, fake_server, workflow):
+    argo_workflow = create_argo_workflow(workflow, shared_env=True)
+    env_secret = create_env_secret(workflow, argo_workflow)
+
+    output = kubernetes_service.create_argo_workflow(argo_workflow, env_secret)
+
+    # only the build, which runs once, keeps the env inline
+    templates = argo_workflow["spec"]["templates"]
+    steps = [template for template in templates if template["name"] != "build"]
+    assert workflow.auth_token not in json.dumps(steps)
+    (secret,) = fake_server.objects("secrets", "argo")
+    assert secret["stringData"]["BOLT_HASURA_TOKEN"] == workflow.auth_token
+    assert secret["metadata"]["ownerReferences"][0]["uid"] == output["metadata"]["uid"]
+
+    kubernetes_service.delete_argo_workflow(output["metadata"]["name"])
+    assert fake_server.objects("secrets") == []
+
+
+def fail_with(status):
+    def fail(*args, **kwargs):
+        raise ApiException(status=status)
+
+    return fail
+
+
+def test_shared_env_secret_rolled_back(
+    kubernetes_service, fake_server, workflow, monkeypatch
+):
+    monkeypatch.setattr(
+        kubernetes_service._core_cli, "patch_namespaced_secret", fail_with(503)
+    )
+    argo_workflow = create_argo_workflow(workflow, shared_env=True)
+    env_secret = create_env_secret(workflow, argo_workflow)
+
+    with pytest.raises(ApiException) as e:
+        kubernetes_service.create_argo_workflow(argo_workflow, env_secret)
+
+    assert e.value.status == 503
+    assert fake_server.objects("workflows") == []
+    assert fake_server.objects("secrets") == []
+
+
+def test_shared_env_secret_kept_after_ambiguous_error(
+    kubernetes_service, fake_server, workflow, monkeypatch
+):
+    monkeypatch.setattr(
+        kubernetes_service._cr_cli, "create_namespaced_custom_object", fail_with(504)
+    )
+    argo_workflow = create_argo_workflow(workflow, shared_env=True)
+    env_secret = create_env_secret(workflow, argo_workflow)
+
+    with pytest.raises(ApiException):
+        kubernetes_service.create_argo_workflow(argo_workflow, env_secret)
+
+    # the workflow may have been created, it would not start without the secret
+    assert len(fake_server.objects("secrets")) == 1
+
+
+def test_failed_rollback_is_not_failed_over(
+    kubernetes_service, fake_server, workflow, monkeypatch, tmp_path
+):
+    monkeypatch.setattr(
+        kubernetes_service._core_cli, "patch_namespaced_secret", fail_with(503)
+    )
+    monkeypatch.setattr(kubernetes_service, "delete_argo_workflow", fail_with(503))
+    argo_workflow = create_argo_workflow(workflow, shared_env=True)
+    env_secret = create_env_secret(workflow, argo_workflow)
+
+    with FakeArgoApiServer() as other_server:
+        kubeconfig = str(tmp_path / "other-kubeconfig")
+        other_server.write_kubeconfig(kubeconfig)
+        services = {
+            "a": kubernetes_service,
+            "b": KubernetesService(config_file=kubeconfig),
+        }
+        policy = PinnedPolicy({workflow.tenant_id: "a"}, ConsistentHashingPolicy())
+        multi_cluster = MultiClusterKubernetesService(services, policy)
+
+        with pytest.raises(RollbackError):
+            multi_cluster.create_argo_workflow(argo_workflow, env_secret)
+
+        assert other_server.objects("workflows") == []
+    assert len(fake_server.objects("workflows")) == 1
+    assert len(fake_server.objects("secrets")) == 1
+
+
+def test_throttling(kubernetes_service, fake_server, workflow):
+    fake_server.rate_limit = 1
+
+    kubernetes_service.create_argo_workflow(create_argo_workflow(workflow))
+    with pytest.raises(ApiException) as e:
+        kubernetes_service.create_argo_workflow(create_argo_workflow(workflow))
+
+    assert e.value.status == 429
+    assert fake_server.stats["throttled"] == 1
+    assert len(fake_server.objects("workflows")) == 1
+
+
+def test_throttling_below_one_request_per_second(
+    kubernetes_service, fake_server, workflow
+):
+    fake_server.rate_limit = 0.5
+
+    kubernetes_service.create_argo_workflow(create_argo_workflow(workflow))
+
+    assert fake_server.stats["throttled"] == 0
+
+
+def test_watch(kubernetes_service, fake_server, workflow):
+    first = kubernetes_service.create_argo_workflow(create_argo_workflow(workflow))
+    kubernetes_service.create_argo_workflow(create_argo_workflow(workflow))
+
+    stream = watch.Watch().stream(
+        kubernetes_service._cr_cli.list_namespaced_custom_object,
+        "argoproj.io",
+        "v1alpha1",
+        "argo",
+        "workflows",
+        resource_version=first["metadata"]["resourceVersion"],
+        timeout_seconds=1,
+    )
+
+    assert [event["type"] for event in stream] == ["ADDED"]
+
+
+def test_watch_expired(kubernetes_service, fake_server, workflow):
+    fake_server.max_events = 1
+    first = kubernetes_service.create_argo_workflow(create_argo_workflow(workflow))
+    for _ in range(2):
+        kubernetes_service.create_argo_workflow(create_argo_workflow(workflow))
+
+    with pytest.raises(ApiException) as e:
+        kubernetes_service._cr_cli.list_namespaced_custom_object(
+            "argoproj.io",
+            "v1alpha1",
+            "argo",
+            "workflows",
+            watch=True,
+            resource_version=first["metadata"]["resourceVersion"],
+        )
+
+    assert e.value.status == 410
+
+
+def test_error_injection(kubernetes_service, fake_server, workflow):
+    fake_server.error_rate = 1
+
+    with pytest.raises(ApiException) as e:
+        kubernetes_service.create_argo_workflow(create_argo_workflow(workflow))
+
+    assert e.value.status == 500
@@ -0,0 +1,113 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import time
+
+from src.argo import COMPLETED_LABEL
+from src.argo import MASTERS_GROUP
+from src.argo import SLAVES_GROUP
+from src.argo import create_argo_workflow
+from src.argo import get_node_groups
+from src.argo import set_prepull_skips
+from src.prepull import PrePullCache
+from src.prepull import PrePullWatcher
+
+
+def test_prepull_steps(workflow):
+    groups = get_node_groups(workflow)
+
+    argo_workflow = create_argo_workflow(workflow, prepull_groups=groups)
+
+    main, *templates = argo_workflow["spec"]["templates"]
+    prepull_steps = main["steps"][1]
+    assert [step["withSequence"]["count"] for step in prepull_steps] == ["1", "2"]
+    assert "prepull" in [template["name"] for template in templates]
+
+
+def test_prepull_skipped_for_pulled_images(workflow):
+    cache = PrePullCache(ttl_seconds=60)
+    cache.mark("a", "world-corp", "test-project", SLAVES_GROUP, "image:1", time.time())
+    argo_workflow = create_argo_workflow(
+        workflow, prepull_groups=[MASTERS_GROUP, SLAVES_GROUP]
+    )
+
+    images = cache.images("a", "world-corp", "test-project", SLAVES_GROUP)
+    set_prepull_skips(argo_workflow, {SLAVES_GROUP: images})
+
+    masters_step, slaves_step = argo_workflow["spec"]["templates"][0]["steps"][1]
+    assert "when" not in masters_step
+    assert slaves_step["when"] == "'{{workflow.outputs.parameters.image}}' != 'image:1'"
+    assert cache.images("b", "world-corp", "test-project", SLAVES_GROUP) == []
+
+
+def prepull_status(image, phases):
+    return {
+        "outputs": {"parameters": [{"name": "image", "value": image}]},
+        "nodes": {
+            f"node-{i}": {
+                "templateName": "prepull",
+                "type": "Retry",
+                "phase": phase,
+                "inputs": {"parameters": [{"name": "group", "value": group}]},
+            }
+            for i, (group, phase) in enumerate(phases)
+        },
+    }
+
+
+def test_record_succeeded_prepulls_only(workflow):
+    cache = PrePullCache(ttl_seconds=60)
+    argo_workflow = create_argo_workflow(workflow)
+    argo_workflow["status"] = prepull_status(
+        "image:2",
+        [
+            (MASTERS_GROUP, "Succeeded"),
+            (SLAVES_GROUP, "Succeeded"),
+            (SLAVES_GROUP, "Failed"),
+        ],
+    )
+
+    cache.record("a", argo_workflow)
+
+    assert cache.images("a", "world-corp", "test-project", MASTERS_GROUP) == ["image:2"]
+    assert cache.images("a", "world-corp", "test-project", SLAVES_GROUP) == []
+
+
+def test_watcher_fetches_completed_workflows_once(
+    kubernetes_service, fake_server, workflow
+):
+    cache = PrePullCache(ttl_seconds=60)
+    for completed in ("true", "false"):
+        argo_workflow = create_argo_workflow(workflow)
+        argo_workflow["metadata"]["labels"][COMPLETED_LABEL] = completed
+        argo_workflow["status"] = prepull_status(
+            f"image:{completed}", [(MASTERS_GROUP, "Succeeded")]
+        )
+        kubernetes_service.create_argo_workflow(argo_workflow)
+    watcher = PrePullWatcher(kubernetes_service, cache)
+
+    watcher.watch()
+    requests = fake_server.stats["requests"]
+    watcher.watch()
+
+    assert cache.images("default", "world-corp", "test-project", MASTERS_GROUP) == [
+        "image:true"
+    ]
+    # only the second list, the recorded workflow is not fetched again
+    assert fake_server.stats["requests"] == requests + 1
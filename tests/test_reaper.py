@@ -0,0 +1,101 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import time
+
+from src.argo import DEADLINE_ANNOTATION
+from src.argo import create_argo_workflow
+from src.reaper import WorkflowReaper
+from src.routing import ConsistentHashingPolicy
+from src.services import KubernetesServiceABC
+from src.services import MultiClusterKubernetesService
+
+
+class UnreachableKubernetesService(KubernetesServiceABC):
+    def create_argo_workflow(self, body=None, env_secret=None, prepare=None):
+        raise ConnectionRefusedError()
+
+    def list_argo_workflows(self, label_selector=None):
+        raise ConnectionRefusedError()
+
+    def get_argo_workflow(self, name):
+        raise ConnectionRefusedError()
+
+    def terminate_argo_workflow(self, name):
+        raise ConnectionRefusedError()
+
+    def delete_argo_workflow(self, name):
+        raise ConnectionRefusedError()
+
+
+def create_overdue_workflow(kubernetes_service, workflow, status=None, deadline=None):
+    overdue = create_argo_workflow(workflow)
+    deadline = deadline or int(time.time()) - 1
+    overdue["metadata"]["annotations"][DEADLINE_ANNOTATION] = str(deadline)
+    if status is not None:
+        overdue["status"] = status
+    return kubernetes_service.create_argo_workflow(overdue)
+
+
+def test_reaper_terminates_overdue_workflows(kubernetes_service, fake_server, workflow):
+    overdue = create_overdue_workflow(kubernetes_service, workflow)
+    kubernetes_service.create_argo_workflow(create_argo_workflow(workflow))
+
+    terminated = WorkflowReaper(kubernetes_service).reap()
+
+    assert terminated == [overdue["metadata"]["name"]]
+    deadlines = {
+        obj["metadata"]["name"]: obj["spec"]["activeDeadlineSeconds"]
+        for obj in fake_server.objects("workflows")
+    }
+    assert deadlines[overdue["metadata"]["name"]] == 0
+    assert sorted(deadlines.values())[1] > 0
+
+
+def test_reaper_skips_unreachable_clusters(kubernetes_service, fake_server, workflow):
+    overdue = create_overdue_workflow(kubernetes_service, workflow)
+    services = {"down": UnreachableKubernetesService(), "up": kubernetes_service}
+    multi_cluster = MultiClusterKubernetesService(services, ConsistentHashingPolicy())
+
+    terminated = WorkflowReaper(multi_cluster).reap()
+
+    assert terminated == [overdue["metadata"]["name"]]
+    (obj,) = fake_server.objects("workflows")
+    assert obj["spec"]["activeDeadlineSeconds"] == 0
+
+
+def test_reaper_leaves_exit_handler_running(kubernetes_service, workflow):
+    exit_node = {"name": "bolt-wf-abc123.onExit", "phase": "Running"}
+    create_overdue_workflow(kubernetes_service, workflow, {"nodes": {"0": exit_node}})
+
+    assert WorkflowReaper(kubernetes_service).reap() == []
+
+
+def test_reaper_deletes_workflows_left_running(
+    kubernetes_service, fake_server, workflow
+):
+    exit_node = {"name": "bolt-wf-abc123.onExit", "phase": "Running"}
+    overdue = create_overdue_workflow(
+        kubernetes_service, workflow, {"nodes": {"0": exit_node}}, deadline=1
+    )
+
+    terminated = WorkflowReaper(kubernetes_service, delete_after_seconds=60).reap()
+
+    assert terminated == [overdue["metadata"]["name"]]
+    assert fake_server.objects("workflows") == []
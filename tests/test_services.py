@@ -0,0 +1,177 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import pytest
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import MaxRetryError
+from urllib3.exceptions import NewConnectionError
+from urllib3.exceptions import ReadTimeoutError
+
+from src.argo import TENANT_LABEL
+from src.routing import ConsistentHashingPolicy
+from src.routing import LeastLoadedPolicy
+from src.routing import PinnedPolicy
+from src.services import KubernetesServiceABC
+from src.services import MultiClusterKubernetesService
+
+
+class FakeKubernetesService(KubernetesServiceABC):
+    def __init__(self, running=0, error=None, down=False):
+        self.running = running
+        self.error = error
+        self.down = down
+        self.created = []
+        self.listed = 0
+
+    def create_argo_workflow(self, body=None, env_secret=None, prepare=None):
+        if self.error is not None:
+            raise self.error
+        self.created.append(body)
+        return body
+
+    def list_argo_workflows(self, label_selector=None):
+        self.listed += 1
+        if self.down:
+            raise ConnectionRefusedError()
+        return [{}] * self.running
+
+    def get_argo_workflow(self, name):
+        return {}
+
+    def terminate_argo_workflow(self, name):
+        pass
+
+    def delete_argo_workflow(self, name):
+        pass
+
+
+def make_body(tenant_id):
+    return {"metadata": {"name": "bolt-wf-abc123", "labels": {TENANT_LABEL: tenant_id}}}
+
+
+def test_consistent_hashing_is_stable():
+    services = {name: FakeKubernetesService() for name in ("a", "b", "c")}
+    policy = ConsistentHashingPolicy()
+
+    order = policy.order(make_body("tenant"), services)
+
+    assert sorted(order) == ["a", "b", "c"]
+    assert policy.order(make_body("tenant"), dict(reversed(services.items()))) == order
+
+
+def test_least_loaded_prefers_idle_cluster():
+    services = {
+        "a": FakeKubernetesService(running=3),
+        "b": FakeKubernetesService(running=1),
+    }
+    policy = LeastLoadedPolicy()
+
+    assert policy.order(make_body("tenant"), services) == ["b", "a"]
+
+    policy.submitted("b")
+    policy.submitted("b")
+    policy.submitted("b")
+    assert policy.order(make_body("tenant"), services) == ["a", "b"]
+
+
+def test_least_loaded_caches_unreachable_cluster():
+    services = {
+        "a": FakeKubernetesService(down=True),
+        "b": FakeKubernetesService(running=1),
+    }
+    policy = LeastLoadedPolicy()
+
+    for _ in range(5):
+        assert policy.order(make_body("tenant"), services) == ["b", "a"]
+
+    assert services["a"].listed == 1
+
+
+def test_pinned_tenant():
+    services = {name: FakeKubernetesService() for name in ("a", "b", "c")}
+    policy = PinnedPolicy({"tenant": "c"}, ConsistentHashingPolicy())
+
+    assert policy.order(make_body("tenant"), services)[0] == "c"
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        ApiException(status=429),
+        ApiException(status=503),
+        MaxRetryError(None, "/", NewConnectionError(None, "connection refused")),
+    ],
+)
+def test_failover_on_submission_failure(error):
+    services = {"a": FakeKubernetesService(error=error), "b": FakeKubernetesService()}
+    service = MultiClusterKubernetesService(
+        services, PinnedPolicy({"tenant": "a"}, LeastLoadedPolicy())
+    )
+
+    service.create_argo_workflow(make_body("tenant"))
+
+    assert len(services["b"].created) == 1
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        ApiException(status=422),
+        ApiException(status=504),
+        ReadTimeoutError(None, "/", "read timed out"),
+    ],
+)
+def test_no_failover_when_workflow_may_exist(error):
+    services = {"a": FakeKubernetesService(error=error), "b": FakeKubernetesService()}
+    service = MultiClusterKubernetesService(
+        services, PinnedPolicy({"tenant": "a"}, LeastLoadedPolicy())
+    )
+
+    with pytest.raises(type(error)):
+        service.create_argo_workflow(make_body("tenant"))
+
+    assert services["b"].created == []
+
+
+def test_prepared_for_each_cluster():
+    services = {
+        "a": FakeKubernetesService(error=ApiException(status=503)),
+        "b": FakeKubernetesService(),
+    }
+    service = MultiClusterKubernetesService(
+        services, PinnedPolicy({"tenant": "a"}, LeastLoadedPolicy())
+    )
+    prepared = []
+
+    service.create_argo_workflow(
+        make_body("tenant"), prepare=lambda body, cluster: prepared.append(cluster)
+    )
+
+    assert prepared == ["a", "b"]
+
+
+def test_all_clusters_failing():
+    services = {
+        "a": FakeKubernetesService(error=ApiException(status=503)),
+        "b": FakeKubernetesService(error=ApiException(status=503)),
+    }
+    service = MultiClusterKubernetesService(services, ConsistentHashingPolicy())
+
+    with pytest.raises(ApiException):
+        service.create_argo_workflow(make_body("tenant"))
@@ -0,0 +1,65 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from src.topology import ResourceProfile
+from src.topology import plan_topology
+
+MASTER = ResourceProfile(requests={}, limits={}, capacity=3)
+SLAVE = ResourceProfile(requests={}, limits={}, capacity=100)
+
+
+def test_users_split_across_slaves():
+    topology = plan_topology(
+        users=10, workers=3, master_profile=MASTER, slave_profile=SLAVE
+    )
+
+    assert [shard.master for shard in topology.shards] == ["load-tests-master"]
+    assert [slave.name for slave in topology.slaves] == [
+        "load-tests-slave-001",
+        "load-tests-slave-002",
+        "load-tests-slave-003",
+    ]
+    assert [slave.users for slave in topology.slaves] == [4, 3, 3]
+
+
+def test_slaves_added_when_over_capacity():
+    topology = plan_topology(
+        users=250, workers=1, master_profile=MASTER, slave_profile=SLAVE
+    )
+
+    assert [slave.users for slave in topology.slaves] == [84, 83, 83]
+
+
+def test_multi_master_sharding():
+    topology = plan_topology(
+        users=700, workers=2, master_profile=MASTER, slave_profile=SLAVE
+    )
+
+    assert len(topology.shards) == 3
+    assert all(len(shard.slaves) <= MASTER.capacity for shard in topology.shards)
+    assert sum(shard.users for shard in topology.shards) == 700
+    assert topology.shards[1].slaves[0].name == "load-tests-master-02-slave-001"
+
+
+def test_no_idle_slaves():
+    topology = plan_topology(
+        users=2, workers=5, master_profile=MASTER, slave_profile=SLAVE
+    )
+
+    assert [slave.users for slave in topology.slaves] == [1, 1]